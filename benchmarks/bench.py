@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+"""
+Benchmarks for s3fs_download, run against a local S3 stand-in so they need no AWS account and measure the library rather than the network.
+By default a moto server is started in a subprocess, so that the memory benchmarks, which trace this process's heap, don't count the
+server's allocations; pass --endpoint-url to use another S3-compatible server (e.g. MinIO) instead.
+
+    python benchmarks/bench.py --output results.json
+    python benchmarks/bench.py --baseline results.json    # exits non-zero if anything got more than 20% slower
+
+Results are written as JSON: one entry per measurement, with its benchmark name, parameters and value.
+"""
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+import statistics
+from datetime import datetime, timezone
+
+import boto3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import s3fs_download as s3dl
+
+BUCKET = 's3fs-download-bench'
+MB = 2**20
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--endpoint-url', help='S3-compatible endpoint to benchmark against. Default: start a moto server.')
+    parser.add_argument('--sizes', default='1,16,64', help='comma-separated object sizes in MB for the throughput benchmark')
+    parser.add_argument('--small-objects', type=int, default=200, help='number of objects in the small-object latency benchmark')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each measurement; the median is reported')
+    parser.add_argument('--output', help='write results to this JSON file (default: stdout)')
+    parser.add_argument('--baseline', help='compare with an earlier JSON result file and exit 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown relative to the baseline. Default: 0.2 (20%%)')
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    server = None
+    endpoint_url = args.endpoint_url
+    if endpoint_url is None:
+        server, endpoint_url = start_moto()
+    client_kwargs = {'endpoint_url': endpoint_url, 'region_name': 'us-east-1'}
+    client = boto3.client('s3', **client_kwargs)
+    try:
+        client.create_bucket(Bucket=BUCKET)
+    except client.exceptions.BucketAlreadyOwnedByYou:
+        pass
+
+    bench = Benchmarks(client, client_kwargs, args.repeat)
+    try:
+        bench.throughput([int(size) * MB for size in args.sizes.split(',')])
+        bench.small_objects(args.small_objects)
+        bench.cache_hits()
+        bench.lazy_vs_eager(max(int(size) for size in args.sizes.split(',')) * MB)
+        bench.memory(max(int(size) for size in args.sizes.split(',')) * MB)
+        bench.lines(max(int(size) for size in args.sizes.split(',')) * MB)
+        bench.arrays(max(int(size) for size in args.sizes.split(',')) * MB)
+    finally:
+        bench.cleanup()
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    report = {
+        'created': datetime.now(timezone.utc).isoformat(),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(), 'endpoint_url': args.endpoint_url or 'moto'},
+        'results': bench.results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(json.load(f)['results'], bench.results, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION: %s' % regression, file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+def start_moto(timeout=30):
+    """
+    Start `python -m moto.server` on a free local port. Returns the process and its endpoint URL once it accepts connections.
+    """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    server = subprocess.Popen([sys.executable, '-m', 'moto.server', '-H', '127.0.0.1', '-p', str(port)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server, 'http://127.0.0.1:%d' % port
+        except OSError:
+            if server.poll() is not None or time.monotonic() > deadline:
+                server.kill()
+                raise RuntimeError("Couldn't start moto.server; is moto[server] installed?")
+            time.sleep(0.1)
+
+class Benchmarks(object):
+    def __init__(self, client, client_kwargs, repeat):
+        self.client = client
+        self.client_kwargs = client_kwargs
+        self.repeat = repeat
+        self.results = []
+        self._dirs = []
+
+    def downloader(self, **kwargs):
+        # S3FileSystem caches instances by their arguments; every benchmark wants a fresh one.
+        s3dl.S3Downloader.clear_instance_cache()
+        return s3dl.S3Downloader(client_kwargs=self.client_kwargs, **kwargs)
+
+    def tmpdir(self):
+        self._dirs.append(tempfile.mkdtemp(prefix='s3fs-download-bench-'))
+        return self._dirs[-1]
+
+    def put(self, key, size):
+        self.client.put_object(Bucket=BUCKET, Key=key, Body=os.urandom(size))
+        return BUCKET + '/' + key
+
+    def record(self, benchmark, unit, values, **params):
+        result = {'benchmark': benchmark, 'params': params, 'unit': unit, 'value': statistics.median(values), 'runs': values}
+        self.results.append(result)
+        print('%-16s %-48s %12.4f %s' % (benchmark, json.dumps(params, sort_keys=True), result['value'], unit), file=sys.stderr)
+
+    def throughput(self, sizes):
+        """
+        Download throughput of a single object, for several object sizes.
+        """
+        for size in sizes:
+            path = self.put('throughput/%d' % size, size)
+            for name, kwargs in [('default', {}), ('auto_buf_size', {'buf_size': 'auto'}), ('streaming', {'streaming': True})]:
+                rates = []
+                for i in range(self.repeat):
+                    d = self.downloader(dir=self.tmpdir(), **kwargs)
+                    start = time.perf_counter()
+                    with d.open(path) as f:
+                        f.read()
+                    rates.append(size / MB / (time.perf_counter() - start))
+                self.record('throughput', 'MB/s', rates, size=size, mode=name)
+
+    def small_objects(self, count):
+        """
+        Per-open latency of many small objects, opened one after another and prefetched in parallel.
+        """
+        paths = [self.put('small/%05d' % i, 4096) for i in range(count)]
+        d = self.downloader(dir=self.tmpdir())
+        latencies = []
+        for path in paths:
+            start = time.perf_counter()
+            with d.open(path) as f:
+                f.read()
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        self.record('small_objects', 's', [statistics.median(latencies)], count=count, statistic='p50')
+        self.record('small_objects', 's', [latencies[int(len(latencies) * 0.99) - 1]], count=count, statistic='p99')
+
+        totals = []
+        for i in range(self.repeat):
+            d = self.downloader(dir=self.tmpdir())
+            start = time.perf_counter()
+            for future in d.prefetch(paths, max_workers=32).values():
+                future.result()
+            totals.append(time.perf_counter() - start)
+        self.record('small_objects', 's', totals, count=count, statistic='prefetch_total')
+
+    def cache_hits(self):
+        """
+        Latency of opening a file that is already cached, for each way a cache hit can be validated.
+        """
+        path = self.put('cache_hit/object', MB)
+        modes = [
+            ('validated', {'use_cache': True}),
+            ('listing', {'use_cache': True}),
+            ('blind', {'use_cache': True, 'validate_cache': False}),
+            ('memory', {'use_cache': True, 'validate_cache': False, 'memory_cache_bytes': 4 * MB, 'memory_cache_max_object': 2 * MB}),
+        ]
+        for name, kwargs in modes:
+            d = self.downloader(dir=self.tmpdir(), **kwargs)
+            d.open(path).close()
+            if name == 'listing':
+                d.list_prefix(BUCKET + '/cache_hit/')
+            latencies = []
+            for i in range(max(self.repeat, 20)):
+                start = time.perf_counter()
+                with d.open(path) as f:
+                    f.read(1)
+                latencies.append(time.perf_counter() - start)
+            self.record('cache_hit', 's', latencies, mode=name)
+
+    def lazy_vs_eager(self, size):
+        """
+        Time to read a small range from the middle of a large object, with and without lazy ranged reads.
+        """
+        path = self.put('lazy/%d' % size, size)
+        for name, kwargs in [('eager', {}), ('lazy', {'lazy': True}), ('lazy_blocks', {'lazy': True, 'block_size': MB})]:
+            times = []
+            for i in range(self.repeat):
+                d = self.downloader(dir=self.tmpdir(), **kwargs)
+                start = time.perf_counter()
+                with d.open(path) as f:
+                    f.seek(size // 2)
+                    f.read(4096)
+                times.append(time.perf_counter() - start)
+            self.record('lazy_vs_eager', 's', times, size=size, mode=name)
+
+    def memory(self, size):
+        """
+        Peak Python heap allocated while downloading one large object, by buffer size.
+        """
+        path = self.put('memory/%d' % size, size)
+        for buf_size in [s3dl.core.DEFAULT_BUFFER_SIZE, 'auto', MB]:
+            d = self.downloader(dir=self.tmpdir(), buf_size=buf_size)
+            tracemalloc.start()
+            with d.open(path):
+                pass
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self.record('memory', 'MB', [peak / MB], size=size, buf_size=buf_size)
+
+    def lines(self, size):
+        """
+        Line iteration throughput over a cached text object, compared with a readline() loop and with a plain open() of the local copy.
+        """
+        line = b'%s\n' % (b'0123456789abcdef' * 4)
+        key = 'lines/%d' % size
+        self.client.put_object(Bucket=BUCKET, Key=key, Body=line * (size // len(line)))
+        path = BUCKET + '/' + key
+        d = self.downloader(dir=self.tmpdir(), use_cache=True, validate_cache=False)
+        d.open(path).close()
+        local = os.path.join(d.dir, key)
+        def readline_loop(f):
+            while f.readline():
+                pass
+        def iterate(f):
+            for line in f:
+                pass
+        cases = [
+            ('readline', lambda: d.open(path), readline_loop),
+            ('iter', lambda: d.open(path), iterate),
+            ('open_readline', lambda: open(local, 'rb'), readline_loop),
+            ('open_iter', lambda: open(local, 'rb'), iterate),
+        ]
+        for name, opener, loop in cases:
+            rates = []
+            for i in range(self.repeat):
+                start = time.perf_counter()
+                with opener() as f:
+                    loop(f)
+                rates.append(size / MB / (time.perf_counter() - start))
+            self.record('lines', 'MB/s', rates, size=size, mode=name)
+
+    def arrays(self, size):
+        """
+        Time and peak Python heap allocated loading a .npy file with load_array(), compared with np.load() of what read() returns.
+        Skipped without numpy.
+        """
+        try:
+            import numpy as np
+        except ImportError:
+            return
+        f = io.BytesIO()
+        np.save(f, np.random.rand(size // 8))
+        self.client.put_object(Bucket=BUCKET, Key='arrays/%d.npy' % size, Body=f.getvalue())
+        path = BUCKET + '/arrays/%d.npy' % size
+        del f
+        cases = [
+            ('load_array', lambda d: d.load_array(path)),
+            ('read_np_load', lambda d: np.load(io.BytesIO(d.open(path).read()))),
+        ]
+        for name, load in cases:
+            times, peaks = [], []
+            for i in range(self.repeat):
+                d = self.downloader()
+                tracemalloc.start()
+                start = time.perf_counter()
+                array = load(d)
+                times.append(time.perf_counter() - start)
+                peaks.append(tracemalloc.get_traced_memory()[1] / MB)
+                tracemalloc.stop()
+                del array
+            self.record('arrays', 's', times, size=size, mode=name)
+            self.record('arrays', 'MB', peaks, size=size, mode=name)
+
+    def cleanup(self):
+        for dir in self._dirs:
+            shutil.rmtree(dir, ignore_errors=True)
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=BUCKET):
+            for obj in page.get('Contents', []):
+                self.client.delete_object(Bucket=BUCKET, Key=obj['Key'])
+
+def compare(baseline, results, tolerance):
+    """
+    Return a description of every result that is worse than the matching baseline result by more than tolerance.
+    Throughput should go up; everything else (latency, memory) should go down.
+    """
+    previous = {(r['benchmark'], json.dumps(r['params'], sort_keys=True)): r['value'] for r in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get((result['benchmark'], json.dumps(result['params'], sort_keys=True)))
+        if not old:
+            continue
+        higher_is_better = result['unit'] == 'MB/s'
+        change = (result['value'] - old) / old
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append('%s %s: %.4g -> %.4g %s' % (result['benchmark'], json.dumps(result['params'], sort_keys=True),
+                                                          old, result['value'], result['unit']))
+    return regressions
+
+if __name__ == '__main__':
+    main()
@@ -1 +1,2 @@
 from .core import *
+from .aio import AsyncS3Downloader, AsyncDownloadedS3File
@@ -0,0 +1,209 @@
+import asyncio
+import os
+import tempfile
+from botocore.exceptions import ClientError
+from s3fs.core import split_path
+from .transfer import part_ranges, pwrite, _object_size, DEFAULT_PART_SIZE, DEFAULT_MAX_CONCURRENCY
+from .blocks import PART_SUFFIX
+from .flight import _remove
+
+try:
+    from aiobotocore.session import get_session
+except ImportError:
+    get_session = None
+
+DEFAULT_MAX_DOWNLOADS = 64
+DEFAULT_CHUNK_SIZE = 2**16
+
+class AsyncS3Downloader(object):
+    def __init__(self, dir='', lazy=False, use_cache=False, part_size=DEFAULT_PART_SIZE,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY, max_downloads=DEFAULT_MAX_DOWNLOADS,
+                 client_kwargs=None, session=None):
+        """
+        Initialize an AsyncS3Downloader, the asyncio counterpart of S3Downloader. Requires aiobotocore.
+        Use it as an async context manager (or call close()) so the underlying client is shut down.
+        Parameters:
+        - dir: directory to save downloaded files in. Downloaded files will be stored at <dir>/<key>.
+        - lazy: Lazy-load files--download on read, not on open.
+        - use_cache: Use cached files if they exist at <dir>/<key>.
+        - part_size: size of each ranged GET when downloading a file. Default: 8MB.
+        - max_concurrency: maximum number of ranged GETs in flight for a single file. Default: 10.
+        - max_downloads: maximum number of files being downloaded at once across all opens. Default: 64.
+        - client_kwargs: extra keyword arguments for aiobotocore's create_client (e.g. endpoint_url, region_name).
+        - session: an existing aiobotocore session.
+        """
+        if get_session is None:
+            raise ImportError("AsyncS3Downloader requires aiobotocore")
+        self.dir = dir
+        self.lazy = lazy
+        self.use_cache = use_cache
+        self.part_size = part_size
+        self.max_concurrency = max_concurrency
+        self.client_kwargs = client_kwargs or {}
+        self.session = session or get_session()
+        self.s3 = None
+        self._client_context = None
+        self._semaphore = asyncio.Semaphore(max_downloads)
+
+    async def __aenter__(self):
+        await self._connect()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def open(self, path):
+        """
+        Open <bucket>/<key> for reading. Downloads the file before returning unless lazy loading is enabled.
+        """
+        f = AsyncDownloadedS3File(self, path)
+        if not self.lazy:
+            await f._ensure_file()
+        return f
+
+    async def close(self):
+        """
+        Shut down the S3 client.
+        """
+        if self._client_context is not None:
+            await self._client_context.__aexit__(None, None, None)
+            self._client_context = None
+            self.s3 = None
+
+    async def _connect(self):
+        if self.s3 is None:
+            self._client_context = self.session.create_client('s3', **self.client_kwargs)
+            self.s3 = await self._client_context.__aenter__()
+        return self.s3
+
+class AsyncDownloadedS3File(object):
+    """
+    AsyncDownloadedS3File is the asyncio counterpart of DownloadedS3File. Reads are coroutines.
+    Response bodies are streamed without blocking the event loop; each chunk is written straight into the local file.
+    Parameters:
+    - s3: an AsyncS3Downloader.
+    - path: <bucket>/<key> path of the file on S3.
+    - mode: file read mode. Currently, the only choice is 'rb'.
+    """
+    def __init__(self, s3, path, mode='rb'):
+        if mode != 'rb':
+            raise NotImplementedError("File mode must be 'rb'")
+        self.s3 = s3
+        self.mode = mode
+        self.path = path
+        self.bucket, self.key = split_path(path)
+        self.closed = False
+        self._file = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    async def read(self, length=-1):
+        """
+        Read downloaded file from cache. Will download if lazy loading is enabled.
+        """
+        f = await self._ensure_file()
+        return f.read(length)
+
+    async def readline(self):
+        """
+        Read a line of the downloaded file from cache. Will download if lazy loading is enabled.
+        """
+        f = await self._ensure_file()
+        return f.readline()
+
+    async def readlines(self):
+        """
+        Read all lines of the downloaded file from cache. Will download if lazy loading is enabled.
+        """
+        f = await self._ensure_file()
+        return f.readlines()
+
+    def close(self):
+        """
+        Close cache file.
+        """
+        if self._file:
+            self._file.close()
+        self.closed = True
+
+    async def _ensure_file(self):
+        if self.closed:
+            raise IOError("Cache closed")
+        if self._file is None:
+            local = os.path.join(self.s3.dir, self.key)
+            if self.s3.use_cache and self.s3.dir and os.path.isfile(local):
+                self._file = open(local, mode='rb')
+            else:
+                async with self.s3._semaphore:
+                    self._file = await self._download()
+                self._file.seek(0)
+        return self._file
+
+    def _get_tmp(self):
+        if self.s3.dir:
+            dir = os.path.dirname(os.path.join(self.s3.dir, self.key))
+            os.makedirs(dir, exist_ok=True)
+            # Downloaded to <key>.part and moved into place once complete, so that use_cache never serves a partial file.
+            return open(os.path.join(self.s3.dir, self.key) + PART_SUFFIX, mode='wb+')
+        else:
+            return tempfile.TemporaryFile(mode='wb+')
+
+    async def _download(self):
+        client = await self.s3._connect()
+        tmp = self._get_tmp()
+        fd = tmp.fileno()
+        try:
+            try:
+                resp = await client.get_object(Bucket=self.bucket, Key=self.key,
+                                               Range='bytes=0-%d' % (self.s3.part_size - 1))
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') != 'InvalidRange':
+                    raise
+                resp = await client.get_object(Bucket=self.bucket, Key=self.key)
+            size = _object_size(resp)
+            os.ftruncate(fd, size)
+
+            ranges = part_ranges(size, self.s3.part_size)
+            parts = asyncio.Semaphore(max(self.s3.max_concurrency - 1, 1))
+            async def fetch(start, end):
+                async with parts:
+                    r = await client.get_object(Bucket=self.bucket, Key=self.key, IfMatch=resp['ETag'],
+                                                Range='bytes=%d-%d' % (start, end - 1))
+                    await _write_stream(r['Body'], fd, start)
+            tasks = [asyncio.ensure_future(_write_stream(resp['Body'], fd, 0))]
+            tasks += [asyncio.ensure_future(fetch(start, end)) for start, end in ranges[1:]]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                # Stop the other parts before the file is closed, or they would keep writing to its (possibly reused) descriptor.
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+        except ClientError:
+            self._discard(tmp)
+            raise IOError("Couldn't download file. Verify that your S3 path is valid and that you have appropriate permissions.")
+        except BaseException:
+            self._discard(tmp)
+            raise
+        if self.s3.dir:
+            os.replace(tmp.name, os.path.join(self.s3.dir, self.key))
+        return tmp
+
+    def _discard(self, tmp):
+        tmp.close()
+        if self.s3.dir:
+            _remove(tmp.name)
+
+async def _write_stream(body, fd, offset):
+    async with body as stream:
+        data = await stream.read(DEFAULT_CHUNK_SIZE)
+        while data:
+            pwrite(fd, data, offset)
+            offset += len(data)
+            data = await stream.read(DEFAULT_CHUNK_SIZE)
+    return offset
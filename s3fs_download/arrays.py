@@ -0,0 +1,66 @@
+import io
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+NPY_MAGIC = b'\x93NUMPY'
+# Size of the first ranged GET of load_array(): enough for any ordinary .npy header, and the whole of small arrays.
+HEADER_PROBE = 2**16
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("Loading arrays requires numpy")
+
+def npy_header_length(prefix):
+    """
+    Return the length of the .npy header (magic, version and header dict) that prefix, the first bytes of a file, starts with,
+    or None if it isn't a .npy file. prefix must hold at least the first 12 bytes of a .npy file.
+    """
+    if not prefix.startswith(NPY_MAGIC) or len(prefix) < 10:
+        return None
+    if prefix[6] == 1:
+        return 10 + struct.unpack('<H', prefix[8:10])[0]
+    return 12 + struct.unpack('<I', prefix[8:12])[0]
+
+def parse_npy_header(header):
+    """
+    Parse a complete .npy header. Returns (dtype, shape, fortran_order).
+    """
+    _require_numpy()
+    f = io.BytesIO(header)
+    version = np.lib.format.read_magic(f)
+    read = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+    # Newer NumPy versions refuse headers over 10000 bytes unless told to expect them.
+    kwargs = {'max_header_size': len(header)} if len(header) > 10000 else {}
+    shape, fortran_order, dtype = read(f, **kwargs)
+    return dtype, shape, fortran_order
+
+def array_layout(header, size, dtype=None):
+    """
+    Work out the layout of an array stored in a file of size bytes that starts with header: its complete .npy header, or b'' for
+    a raw file of dtype values (default: uint8), which is loaded as a one-dimensional array. For .npy files, dtype must match the
+    header's if given. Returns (shape, dtype, fortran_order, offset of the data).
+    """
+    _require_numpy()
+    if not header:
+        dtype = np.dtype(dtype or 'uint8')
+        if size % dtype.itemsize:
+            raise ValueError("The file is %d bytes, which isn't a whole number of %s values" % (size, dtype))
+        return (size // dtype.itemsize,), dtype, False, 0
+    file_dtype, shape, fortran_order = parse_npy_header(header)
+    if dtype is not None and np.dtype(dtype) != file_dtype:
+        raise ValueError("The file holds %s values, not %s" % (file_dtype, np.dtype(dtype)))
+    if file_dtype.hasobject:
+        raise ValueError("The file holds Python objects, which can't be loaded without unpickling")
+    return shape, file_dtype, fortran_order, len(header)
+
+def empty_array(shape, dtype, fortran_order=False):
+    """
+    Allocate an uninitialized array, and return it with a writable byte view of its memory, in the order the data is stored.
+    """
+    _require_numpy()
+    array = np.empty(shape, dtype, order='F' if fortran_order else 'C')
+    return array, memoryview(array.reshape(-1, order='A').view(np.uint8))
@@ -0,0 +1,98 @@
+import os
+from .transfer import pwrite
+
+PART_SUFFIX = '.part'
+
+class BlockMap(object):
+    """
+    A bitmap of which fixed-size blocks of an S3 object are present locally.
+    Parameters:
+    - size: size of the S3 object.
+    - block_size: size of each block. The last block may be shorter.
+    - bitmap: bitmap of the blocks already present, e.g. as persisted in the cache index. Default: no blocks.
+    """
+    def __init__(self, size, block_size, bitmap=None):
+        self.size = size
+        self.block_size = block_size
+        self.nblocks = (size + block_size - 1) // block_size
+        self.bitmap = bytearray(bitmap or b'')
+        self.bitmap.extend(b'\0' * ((self.nblocks + 7) // 8 - len(self.bitmap)))
+
+    def has(self, block):
+        return bool(self.bitmap[block >> 3] & (1 << (block & 7)))
+
+    def mark(self, start, end):
+        """
+        Record that bytes [start, end) are present. Only blocks that lie entirely inside the range are marked.
+        """
+        last = self.nblocks if end >= self.size else end // self.block_size
+        for block in range(-(-start // self.block_size), last):
+            self.bitmap[block >> 3] |= 1 << (block & 7)
+
+    def present_ranges(self):
+        """
+        Return the (start, end) byte ranges of the blocks that are present.
+        """
+        ranges = []
+        for block in range(self.nblocks):
+            if not self.has(block):
+                continue
+            block_start = block * self.block_size
+            block_end = min(block_start + self.block_size, self.size)
+            if ranges and ranges[-1][1] == block_start:
+                ranges[-1] = (ranges[-1][0], block_end)
+            else:
+                ranges.append((block_start, block_end))
+        return ranges
+
+    def missing_ranges(self, start=0, end=None, max_length=None):
+        """
+        Return the (start, end) byte ranges of the blocks overlapping [start, end) that aren't present yet.
+        Adjacent missing blocks are merged into one range of at most max_length bytes.
+        """
+        end = self.size if end is None else min(end, self.size)
+        ranges = []
+        for block in range(start // self.block_size, (end + self.block_size - 1) // self.block_size):
+            if self.has(block):
+                continue
+            block_start = block * self.block_size
+            block_end = min(block_start + self.block_size, self.size)
+            if ranges and ranges[-1][1] == block_start and \
+                    (max_length is None or block_end - ranges[-1][0] <= max_length):
+                ranges[-1] = (ranges[-1][0], block_end)
+            else:
+                ranges.append((block_start, block_end))
+        return ranges
+
+    def complete(self):
+        return not self.missing_ranges()
+
+class BlockFile(BlockMap):
+    """
+    A sparse local copy of an S3 object that is filled in one block at a time.
+    Blocks live at their own offsets in a sparse file; the BlockMap records which of them are present.
+    Parameters:
+    - path: local file holding the blocks. Created (sparse) if it doesn't exist.
+    - size, block_size, bitmap: as for BlockMap.
+    """
+    def __init__(self, path, size, block_size, bitmap=None):
+        super(BlockFile, self).__init__(size, block_size, bitmap)
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self.fd).st_size != size:
+            os.ftruncate(self.fd, size)
+
+    def write(self, offset, data):
+        pwrite(self.fd, data, offset)
+
+    def read(self, start, end):
+        """
+        Read bytes [start, end) from the local file. The blocks must be present.
+        """
+        return os.pread(self.fd, max(min(end, self.size) - start, 0), start)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
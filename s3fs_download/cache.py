@@ -0,0 +1,273 @@
+import os
+import time
+import shutil
+import sqlite3
+import tempfile
+import threading
+from contextlib import closing
+from .blocks import PART_SUFFIX
+
+INDEX_NAME = '.s3fs_download.sqlite'
+
+# Columns to sort by to list eviction candidates first; each order has an index (see CacheIndex.SCHEMA), ending with the key so
+# that the order is total and can be read a batch at a time.
+EVICTION_ORDER = {
+    'lru': ('last_access', 'key'),
+    'lfu': ('hits', 'last_access', 'key'),
+}
+# Number of entries eviction_candidates() reads at a time.
+EVICTION_BATCH = 64
+
+class CacheIndex(object):
+    """
+    Metadata about the files cached in a download directory: the ETag, size and LastModified of the S3 object
+    each local copy was downloaded from, the space the copy takes on disk, plus access times and hit counts for eviction.
+    Stored in a SQLite database at <dir>/.s3fs_download.sqlite, so it persists across processes and can be shared by several
+    processes using the same directory. The total size of the cache on disk is kept up to date by triggers, so it never
+    requires a directory walk.
+    Parameters:
+    - dir: the download directory.
+    """
+    COLUMNS = [
+        ('key', 'TEXT PRIMARY KEY'),
+        ('bucket', 'TEXT'),
+        ('etag', 'TEXT'),
+        ('size', 'INTEGER'),
+        ('last_modified', 'TEXT'),
+        ('last_access', 'REAL DEFAULT 0'),
+        ('hits', 'INTEGER DEFAULT 0'),
+        # Set while only some blocks of the object are cached, in <key>.part; NULL once the whole file is at <key>.
+        ('block_size', 'INTEGER'),
+        ('blocks', 'BLOB'),
+        ('downloaded_at', 'REAL'),
+        # '<algorithm>:<value>' checksum the download was verified against, if any.
+        ('digest', 'TEXT'),
+        # Bytes the file takes on disk, when that differs from size (e.g. compressed or decompressed copies); NULL means size.
+        ('physical_size', 'INTEGER'),
+        # 'zstd' if the file is stored in the zstd seekable format (see seekable.py), NULL if it's stored as is.
+        ('compression', 'TEXT'),
+    ]
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER NOT NULL);
+        INSERT OR IGNORE INTO totals VALUES (0, (SELECT COALESCE(SUM(COALESCE(physical_size, size)), 0) FROM entries));
+        CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+            UPDATE totals SET size = size + COALESCE(NEW.physical_size, NEW.size, 0);
+        END;
+        CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE OF size, physical_size ON entries BEGIN
+            UPDATE totals SET size = size + COALESCE(NEW.physical_size, NEW.size, 0) - COALESCE(OLD.physical_size, OLD.size, 0);
+        END;
+        CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+            UPDATE totals SET size = size - COALESCE(OLD.physical_size, OLD.size, 0);
+        END;
+        DROP INDEX IF EXISTS entries_last_access;
+        CREATE INDEX IF NOT EXISTS entries_lru ON entries (last_access, key);
+        CREATE INDEX IF NOT EXISTS entries_lfu ON entries (hits, last_access, key);
+    '''
+
+    def __init__(self, dir):
+        self.dir = dir
+        self.path = os.path.join(dir, INDEX_NAME)
+        self._migrated = False
+
+    def get(self, key):
+        """
+        Return the entry for key as a dict, or None if key isn't cached.
+        """
+        with self._connect() as conn:
+            row = conn.execute('SELECT * FROM entries WHERE key = ?', (key,)).fetchone()
+        return dict(row) if row else None
+
+    def put(self, key, **fields):
+        """
+        Insert the entry for key, or update the given fields if it already exists.
+        """
+        fields['key'] = key
+        names = ', '.join(fields)
+        marks = ', '.join('?' * len(fields))
+        updates = ', '.join('%s = excluded.%s' % (name, name) for name in fields)
+        with self._connect() as conn:
+            conn.execute('INSERT INTO entries (%s) VALUES (%s) ON CONFLICT (key) DO UPDATE SET %s'
+                         % (names, marks, updates), list(fields.values()))
+
+    def touch(self, key):
+        """
+        Record an access to key.
+        """
+        with self._connect() as conn:
+            conn.execute('UPDATE entries SET last_access = ?, hits = hits + 1 WHERE key = ?', (time.time(), key))
+
+    def total_size(self):
+        """
+        Total size in bytes of all cached files, as stored on disk.
+        """
+        with self._connect() as conn:
+            return conn.execute('SELECT size FROM totals').fetchone()[0]
+
+    def eviction_candidates(self, policy='lru', batch_size=EVICTION_BATCH):
+        """
+        Return an iterator of (key, size on disk) pairs of the cached files, in the order policy would evict them.
+        Entries are read batch_size at a time along the policy's index, so a caller that stops once it has freed enough space
+        doesn't read (or sort) the whole index.
+        """
+        if policy not in EVICTION_ORDER:
+            raise ValueError("Eviction policy must be one of %s" % ', '.join(sorted(EVICTION_ORDER)))
+        return self._eviction_candidates(EVICTION_ORDER[policy], batch_size)
+
+    def _eviction_candidates(self, columns, batch_size):
+        order = ', '.join(columns)
+        query = 'SELECT key, COALESCE(physical_size, size), %s FROM entries %%s ORDER BY %s LIMIT ?' % (order, order)
+        after = None
+        while True:
+            # A connection per batch: the caller removes entries between batches, which an open read would block.
+            with self._connect() as conn:
+                if after is None:
+                    rows = conn.execute(query % '', (batch_size,)).fetchall()
+                else:
+                    rows = conn.execute(query % 'WHERE (%s) > (%s)' % (order, ', '.join('?' * len(columns))),
+                                        list(after) + [batch_size]).fetchall()
+            for row in rows:
+                yield row[0], row[1]
+            if len(rows) < batch_size:
+                return
+            after = tuple(rows[-1])[2:]
+
+    def keys(self, bucket=None, prefix=''):
+        """
+        Return the cached keys that start with prefix, optionally only those downloaded from bucket.
+        """
+        query = 'SELECT key FROM entries WHERE substr(key, 1, ?) = ?'
+        params = [len(prefix), prefix]
+        if bucket is not None:
+            query += ' AND bucket = ?'
+            params.append(bucket)
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute(query, params)]
+
+    def remove(self, key):
+        """
+        Forget key. Does not touch the cached file itself.
+        """
+        with self._connect() as conn:
+            conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+
+    def _connect(self):
+        # A connection per operation keeps the index safe to use from several threads and processes,
+        # and tolerates the directory being removed out from under us.
+        os.makedirs(self.dir, exist_ok=True)
+        if not os.path.exists(self.path):
+            self._migrated = False
+        conn = sqlite3.connect(self.path, timeout=60)
+        conn.row_factory = sqlite3.Row
+        conn.execute('CREATE TABLE IF NOT EXISTS entries (%s)' % ', '.join(' '.join(c) for c in self.COLUMNS))
+        if not self._migrated:
+            # Indexes written by older versions may be missing columns.
+            existing = set(row[1] for row in conn.execute('PRAGMA table_info(entries)'))
+            for name, type in self.COLUMNS:
+                if name not in existing:
+                    conn.execute('ALTER TABLE entries ADD COLUMN %s %s' % (name, type))
+            if 'physical_size' not in existing:
+                # Older versions' totals count logical sizes; recount them, and recreate the triggers, from physical sizes.
+                conn.executescript('''
+                    DROP TRIGGER IF EXISTS entries_insert;
+                    DROP TRIGGER IF EXISTS entries_update;
+                    DROP TRIGGER IF EXISTS entries_delete;
+                    DROP TABLE IF EXISTS totals;
+                ''')
+            conn.executescript(self.SCHEMA)
+            self._migrated = True
+        return _Connection(conn)
+
+class CacheTier(object):
+    """
+    One level of the cache hierarchy: a directory of cached files with its own index and capacity,
+    e.g. a small local NVMe disk above a large shared network mount.
+    Parameters:
+    - dir: the directory. Files are stored at <dir>/<key>.
+    - max_bytes: maximum total size of the files in dir. Default: None (unbounded).
+    - index: the tier's CacheIndex, if one is already open. Default: a new CacheIndex for dir.
+    """
+    def __init__(self, dir, max_bytes=None, index=None):
+        self.dir = dir
+        self.max_bytes = max_bytes
+        self.index = index or CacheIndex(dir)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(self.dir, key)
+
+    def lookup(self, key):
+        """
+        Return the index entry for key if the tier holds a complete copy of it, or None. Counts as a hit or a miss.
+        """
+        entry = self.index.get(key)
+        if entry is not None and (entry['blocks'] is not None or not os.path.isfile(self.path(key))):
+            entry = None
+        self.record(entry is not None)
+        return entry
+
+    def holds(self, key, etag):
+        """
+        Whether the tier already holds a complete copy of key at etag.
+        """
+        entry = self.index.get(key)
+        return entry is not None and entry['blocks'] is None and entry['etag'] == etag and os.path.isfile(self.path(key))
+
+    def record(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def store(self, key, source, entry):
+        """
+        Copy the file at source into the tier as key, recording entry's ETag, sizes, LastModified and compression in the tier's index.
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # Copy next to the destination first, so readers never see a partial file. The temporary file's name is unique, since
+        # several nodes sharing the tier may store the same key at once.
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.', suffix=PART_SUFFIX)
+        os.close(fd)
+        try:
+            shutil.copyfile(source, tmp)
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except FileNotFoundError:
+                pass
+            raise
+        self.index.put(key, bucket=entry['bucket'], etag=entry['etag'], size=entry['size'],
+                       last_modified=entry['last_modified'], block_size=None, blocks=None,
+                       physical_size=entry['physical_size'], compression=entry['compression'])
+        self.index.touch(key)
+
+    def discard(self, key):
+        """
+        Remove key's file, any partial download of it, and its index entry.
+        """
+        for path in (self.path(key), self.path(key) + PART_SUFFIX):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.index.remove(key)
+
+class _Connection(object):
+    # sqlite3.Connection's context manager commits but doesn't close.
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, exc_type, *args):
+        with closing(self.conn):
+            if exc_type is None:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
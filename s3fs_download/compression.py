@@ -0,0 +1,119 @@
+import io
+import bz2
+import zlib
+import posixpath
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+CODECS = ('gzip', 'bz2', 'zstd', 'lz4')
+EXTENSIONS = {
+    '.gz': 'gzip',
+    '.gzip': 'gzip',
+    '.bz2': 'bz2',
+    '.zst': 'zstd',
+    '.zstd': 'zstd',
+    '.lz4': 'lz4',
+}
+# Files decompressed while downloading are cached at <dir>/<key>.decompressed, next to any compressed copy.
+DECOMPRESSED_SUFFIX = '.decompressed'
+DEFAULT_CHUNK_SIZE = 2**20
+
+def detect_codec(key):
+    """
+    Return the codec implied by key's extension ('gzip', 'bz2', 'zstd' or 'lz4'), or None if it doesn't look compressed.
+    """
+    return EXTENSIONS.get(posixpath.splitext(key)[1].lower())
+
+def check_codec(codec):
+    """
+    Raise if codec is unknown, or if the package it needs isn't installed.
+    """
+    if codec not in CODECS:
+        raise ValueError("decompress must be 'auto' or one of %s" % ', '.join(CODECS))
+    if codec == 'zstd' and zstandard is None:
+        raise ImportError("Decompressing zstd requires the zstandard package")
+    if codec == 'lz4' and lz4_frame is None:
+        raise ImportError("Decompressing lz4 requires the lz4 package")
+
+class Decoder(object):
+    """
+    Incrementally decompresses a stream of one or more concatenated members or frames (as written by e.g. `cat a.gz b.gz`).
+    Parameters:
+    - codec: 'gzip', 'bz2', 'zstd' or 'lz4'.
+    """
+    def __init__(self, codec):
+        check_codec(codec)
+        self.codec = codec
+        self._obj = self._new()
+
+    def decompress(self, data):
+        """
+        Feed compressed data and return whatever decompressed data it completes.
+        """
+        out = []
+        while data:
+            out.append(self._obj.decompress(data))
+            if not getattr(self._obj, 'eof', False):
+                break
+            # The member or frame ended; anything after it starts the next one.
+            data = self._obj.unused_data
+            self._obj = self._new()
+        return b''.join(out)
+
+    def _new(self):
+        if self.codec == 'gzip':
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if self.codec == 'bz2':
+            return bz2.BZ2Decompressor()
+        if self.codec == 'zstd':
+            return zstandard.ZstdDecompressor().decompressobj()
+        return lz4_frame.LZ4FrameDecompressor()
+
+class DecompressingReader(io.RawIOBase):
+    """
+    A raw, read-only stream of the decompressed contents of a compressed file object. Closing it closes the underlying file.
+    Wrap it in io.BufferedReader for readline() and iteration; open_decompressed() does both.
+    Parameters:
+    - raw: the compressed file object. Only its read(n) is used.
+    - codec: 'gzip', 'bz2', 'zstd' or 'lz4'.
+    - chunk_size: number of compressed bytes to read at a time. Default: 1MB.
+    """
+    def __init__(self, raw, codec, chunk_size=DEFAULT_CHUNK_SIZE):
+        super(DecompressingReader, self).__init__()
+        self.raw = raw
+        self.chunk_size = chunk_size
+        self._decoder = Decoder(codec)
+        self._pending = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._pending:
+            data = self.raw.read(self.chunk_size)
+            if not data:
+                return 0
+            self._pending = memoryview(self._decoder.decompress(data))
+        n = min(len(b), len(self._pending))
+        b[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.raw.close()
+        super(DecompressingReader, self).close()
+
+def open_decompressed(raw, codec, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Return a buffered, read-only file object of the decompressed contents of raw.
+    """
+    return io.BufferedReader(DecompressingReader(raw, codec, chunk_size), buffer_size=chunk_size)
@@ -1,29 +1,531 @@
 import io
 import os
+import mmap
+import time
 import tempfile
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from s3fs import S3FileSystem, S3File
 from s3fs.core import split_path
 from botocore.exceptions import ClientError
+from .transfer import ParallelDownload, DownloadProgress, DownloadCancelled, ChecksumMismatch, expected_checksum, resolved, StreamingChecksum, _object_size, \
+    part_ranges, DEFAULT_PART_SIZE, DEFAULT_MAX_CONCURRENCY, DEFAULT_CHECKSUM_RETRIES
+from .cache import CacheIndex, CacheTier, EVICTION_ORDER
+from .blocks import BlockMap, BlockFile, PART_SUFFIX
+from .locks import FileLock, lock_path
+from .flight import SingleFlight, _remove
+from .memory import MemoryCache, DEFAULT_MEMORY_OBJECT_SIZE
+from .listing import ListingCache, DEFAULT_LISTING_TTL
+from .stats import DownloadStats, StatsdExporter
+from .compression import detect_codec, check_codec, open_decompressed, Decoder, DECOMPRESSED_SUFFIX
+from .arrays import npy_header_length, array_layout, empty_array, _require_numpy, HEADER_PROBE
+from .seekable import SeekableZstdFile, compress_file, _require_zstandard, DEFAULT_FRAME_SIZE, DEFAULT_COMPRESSION_LEVEL
 
 DEFAULT_BUFFER_SIZE = 2**20 * 256
+DEFAULT_RANGE_READAHEAD = 2**20
+DEFAULT_LINE_BLOCK_SIZE = 2**20
+DOWNLOAD_ERROR = "Couldn't download file. Verify that your S3 path is valid and that you have appropriate permissions."
 
 class S3Downloader(S3FileSystem):
-    def __init__(self, dir='', lazy=False, use_cache=False, *args, **kwargs):
+    def __init__(self, dir='', lazy=False, use_cache=False, *args, validate_cache=True, part_size=DEFAULT_PART_SIZE,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY, max_cache_bytes=None, eviction_policy='lru',
+                 read_mode='file', streaming=False, range_readahead=DEFAULT_RANGE_READAHEAD,
+                 block_size=None, buf_size=DEFAULT_BUFFER_SIZE, lock_downloads=True,
+                 memory_cache_bytes=None, memory_cache_max_object=DEFAULT_MEMORY_OBJECT_SIZE, tiers=None,
+                 listing_ttl=DEFAULT_LISTING_TTL, verify=True, on_open=None, decompress_mode='read', cache_compression=None,
+                 cache_compression_level=DEFAULT_COMPRESSION_LEVEL, cache_frame_size=DEFAULT_FRAME_SIZE, **kwargs):
         """
         Initialize an S3Downloader, a derivative of the s3fs.S3FileSystem class.
         Parameters:
         - dir: directory to save downloaded files in. If the directory does not exist, it will be created. Downloaded files will be stored at <dir>/<key>.
         - lazy: Lazy-load files--download on read, not on open.
-        - use_cached: Use cached files if they exist at <dir>/<key>. Useful if you're processing the same data multiple times. Does not check to see if files is stale relative to the S3 bucket.
+        - use_cache: Use cached files if they exist at <dir>/<key>. Useful if you're processing the same data multiple times.
+        - validate_cache: Check cached files against S3 before using them. The ETag, size and LastModified of each download are kept in <dir>/.s3fs_download.sqlite;
+          on open, a conditional GET re-downloads the file only if the object's ETag has changed. If False, cached files are used without checking whether they are stale. Default: True.
+        - part_size: size of each ranged GET when downloading a file. Default: 8MB.
+        - max_concurrency: maximum number of ranged GETs in flight for a single file. Default: 10.
+        - max_cache_bytes: maximum total size of the files in dir. After each download, cached files are evicted until the cache fits.
+          Files open in this process are never evicted. Default: None (unbounded).
+        - eviction_policy: 'lru' (evict the least recently used files first) or 'lfu' (evict the least frequently used files first). Default: 'lru'.
+        - read_mode: 'file' to read through a regular file object, or 'mmap' to memory-map each file and return read-only memoryview slices of it
+          from read() instead of copies. Default: 'file'.
+        - streaming: Download in a background thread and let read() and readline() return data as soon as it has landed on disk,
+          instead of waiting for the whole file. Default: False.
+        - range_readahead: minimum number of bytes fetched by each ranged GET once a lazy file that hasn't been downloaded is seek()ed. Default: 1MB.
+        - block_size: Enable the block cache for lazy files. read(n) then fetches only the missing block_size blocks it touches into a sparse file
+          at <dir>/<key>.part, and the bitmap of fetched blocks is kept in the cache index, so later opens reuse them as long as the object's ETag
+          is unchanged. Reading the whole file fills in the remaining blocks and moves the file to <dir>/<key>. Requires dir. Default: None (disabled).
+        - buf_size: size of chunk to read from S3 before writing to disk, or 'auto' to pick the chunk size from each part's length and the observed
+          throughput. Each download thread reuses a single buffer of at most this size (never more than part_size). Default: 256MB.
+        - lock_downloads: Take a per-key fcntl.flock lock under <dir>/.s3fs_download.locks while downloading, so that when several processes
+          share dir, only one downloads a key and the others wait for it and then read the finished file. Time spent waiting is counted in
+          metrics['lock_waits'] and metrics['lock_wait_seconds']. Default: True.
+        - memory_cache_bytes: Keep recently read small objects in memory, up to this many bytes in total, evicting the least recently used.
+          Opens of a cached object read straight from memory after checking its ETag with a HEAD request or a listing from list_prefix()
+          (no check at all if validate_cache is False); a changed ETag drops it from memory and downloads it again. Hits and misses are counted in metrics['memory_hits'] and
+          metrics['memory_misses']. Default: None (disabled).
+        - memory_cache_max_object: largest object to keep in memory. Default: 1MB.
+        - tiers: slower cache directories below dir, fastest first, as a list of (directory, max_bytes) pairs (max_bytes may be None), e.g.
+          [('/mnt/nfs/s3cache', 2**40)] under a dir on local NVMe. With use_cache, a file missing from dir is copied up from the first tier
+          that has it before falling back to S3; files evicted from a tier are copied down to the next one, and the last tier deletes them.
+          Each tier has its own index. tier_stats() reports hits and misses for every tier. Requires dir. Default: None.
+        - listing_ttl: how long, in seconds, listings made by list_prefix() are used to validate opens instead of asking S3. Default: 60.
+        - verify: Checksum every download as it streams to disk and compare it with the object's ETag (the MD5 of single-part uploads, or of
+          each part's MD5 for multipart uploads) or, for encrypted objects, its x-amz-checksum-* headers. A mismatch downloads the object again,
+          up to twice, before raising ChecksumMismatch; streaming downloads aren't retried. The verified checksum is stored in the cache index,
+          so cached copies never need hashing again. Retries are counted in metrics['checksum_retries']. Default: True.
+        - on_open: called with a dict describing each open once its file is ready: path, source (the cache tier that served it: 'memory',
+          a cache directory, 'shared' for another open's in-flight download, or 's3'), hit, seconds (time to get the file), ttfb (latency
+          of the first GET), bytes (downloaded), throughput (bytes per second), retries and disk_write_seconds. For example,
+          StatsdExporter('localhost', 8125) sends them to statsd. The same events are aggregated into histograms by stats(). Default: None.
+        - decompress_mode: how open(path, decompress=...) decompresses. 'read' caches the compressed object at <dir>/<key> as usual and
+          decompresses it as it's read; 'download' decompresses it while downloading (with a single sequential GET) and caches the result
+          at <dir>/<key>.decompressed, trading disk space for faster repeated reads. Default: 'read'.
+        - cache_compression: 'zstd' to store files in dir compressed, in the zstd seekable format: independent frames of cache_frame_size
+          bytes plus a table of their offsets, so reads and seeks decompress only the frames they touch. Reads see the original contents.
+          The index records each file's logical size (the object's) and physical size (on disk); max_cache_bytes and tier budgets count
+          physical sizes. Files are compressed once their download completes; partial downloads and block caches stay uncompressed.
+          In mmap read_mode, as_buffer() decompresses the whole file into memory. prefetch() doesn't return the filenames of compressed
+          files. Requires dir and the zstandard package. Default: None.
+        - cache_compression_level: zstd compression level. Default: 3.
+        - cache_frame_size: uncompressed size of each compressed frame. Default: 1MB.
         """
+        if eviction_policy not in EVICTION_ORDER:
+            raise ValueError("Eviction policy must be one of %s" % ', '.join(sorted(EVICTION_ORDER)))
+        if read_mode not in ('file', 'mmap'):
+            raise ValueError("read_mode must be 'file' or 'mmap'")
+        if decompress_mode not in ('read', 'download'):
+            raise ValueError("decompress_mode must be 'read' or 'download'")
+        if cache_compression not in (None, 'zstd'):
+            raise ValueError("cache_compression must be None or 'zstd'")
+        if cache_compression and not dir:
+            raise ValueError("Cache compression requires a download directory (dir)")
+        if cache_compression:
+            _require_zstandard()
+        if tiers and not dir:
+            raise ValueError("Cache tiers require a download directory (dir)")
         self.dir = dir
         self.lazy = lazy
         self.use_cache = use_cache
+        self.validate_cache = validate_cache
+        self.part_size = part_size
+        self.max_concurrency = max_concurrency
+        self.max_cache_bytes = max_cache_bytes
+        self.eviction_policy = eviction_policy
+        self.read_mode = read_mode
+        self.streaming = streaming
+        self.range_readahead = range_readahead
+        self.block_size = block_size
+        self.buf_size = buf_size
+        self.lock_downloads = lock_downloads
+        self.memory_cache_max_object = memory_cache_max_object
+        self.verify = verify
+        self.decompress_mode = decompress_mode
+        self.cache_compression = cache_compression
+        self.cache_compression_level = cache_compression_level
+        self.cache_frame_size = cache_frame_size
+        self.metrics = Counter()
+        self._metrics_lock = threading.Lock()
+        self._prefetched = set()
+        self._index = CacheIndex(dir) if dir else None
+        self._tiers = [CacheTier(dir, max_cache_bytes, self._index)] if dir else []
+        self._tiers.extend(CacheTier(tier_dir, tier_bytes) for tier_dir, tier_bytes in tiers or [])
+        self._open_keys = Counter()
+        self._open_lock = threading.Lock()
+        self._flights = SingleFlight()
+        self._memory = MemoryCache(memory_cache_bytes) if memory_cache_bytes else None
+        self._listings = ListingCache(listing_ttl)
+        self.on_open = on_open
+        self._stats = DownloadStats()
         
         super(S3Downloader, self).__init__(*args, **kwargs)
     
-    def open(self, path):
-        return DownloadedS3File(self, path)
+    def open(self, path, decompress=None):
+        """
+        Open <bucket>/<key> for reading.
+        Parameters:
+        - decompress: 'gzip', 'bz2', 'zstd' or 'lz4' to read the object's decompressed contents, or 'auto' to pick the codec from the key's
+          extension (.gz, .bz2, .zst, .lz4), reading objects without one as they are. zstd and lz4 need the zstandard and lz4 packages.
+          See decompress_mode. Default: None (no decompression).
+        """
+        codec = detect_codec(path) if decompress == 'auto' else decompress
+        if codec is None:
+            return DownloadedS3File(self, path, buf_size=self.buf_size)
+        check_codec(codec)
+        if self.decompress_mode == 'download':
+            return DownloadedS3File(self, path, buf_size=self.buf_size, decompress=codec)
+        return open_decompressed(DownloadedS3File(self, path, buf_size=self.buf_size), codec)
+
+    def prefetch(self, paths, max_workers=DEFAULT_MAX_CONCURRENCY):
+        """
+        Download many files into dir concurrently. Later calls to open() on any of them are served from the local copy.
+        Parameters:
+        - paths: a <bucket>/<key> path or glob pattern, or a list of them.
+        - max_workers: maximum number of files to download at once. Default: 10.
+        Returns a dict mapping each <bucket>/<key> path to a concurrent.futures.Future, which resolves to the local filename
+        or raises the download's exception. Files stored compressed (see cache_compression) hold zstd frames rather than the object's
+        bytes, so their futures resolve to None instead: read them through open().
+        """
+        if not self.dir:
+            raise ValueError("prefetch() requires a download directory (dir)")
+        pool = ThreadPoolExecutor(max_workers=max_workers)
+        futures = {path: pool.submit(self._prefetch_one, path) for path in self._expand_paths(paths)}
+        pool.shutdown(wait=False)
+        return futures
+
+    def _prefetch_one(self, path):
+        with DownloadedS3File(self, path, buf_size=self.buf_size) as f:
+            if not f._downloaded:
+                f._file = f._get_file()
+            if f._thread is not None:
+                # Streaming: closing would cancel the download, so let it finish (and install the file) first.
+                f._thread.join()
+                f._thread = None
+                f._wait()
+        self._prefetched.add(f.cache_key)
+        entry = self._index.get(f.cache_key) if self._index is not None else None
+        if entry is not None and entry['compression']:
+            return None
+        return os.path.join(self.dir, f.cache_key)
+
+    def load_array(self, path, dtype=None):
+        """
+        Load a .npy file, or a raw binary file of dtype values, into a new NumPy array, downloading straight into the array's memory:
+        one small ranged GET fetches the header (and all of a small array), the array is allocated once, and parallel ranged GETs of
+        part_size bytes read into their slices of its buffer. Nothing is written to dir, and peak memory is about the size of the array.
+        Downloads are verified as with verify. Requires numpy.
+        Parameters:
+        - path: <bucket>/<key> path of the file on S3. Files are recognised as .npy by their magic bytes, whatever their extension.
+        - dtype: the type of a raw file's values; it is loaded as a one-dimensional array. Default: uint8.
+          .npy files use the dtype in their header; if dtype is given, it must match.
+        """
+        _require_numpy()
+        bucket, key = split_path(path)
+        transfer = ParallelDownload(self.s3, bucket, key, part_size=self.part_size, max_concurrency=self.max_concurrency)
+        try:
+            resp = self.s3.get_object(Bucket=bucket, Key=key, Range='bytes=0-%d' % (HEADER_PROBE - 1))
+            size = _object_size(resp)
+            probe = resp['Body'].read()
+            transfer.etag = resp['ETag']
+            header_length = npy_header_length(probe)
+            if header_length is not None and header_length > len(probe):
+                probe = self.s3.get_object(Bucket=bucket, Key=key, Range='bytes=0-%d' % (header_length - 1),
+                                           IfMatch=transfer.etag)['Body'].read()
+            # Multipart part sizes are looked up while the array downloads.
+            expected = expected_checksum(self.s3, bucket, key, resp, background=True, max_workers=self.max_concurrency) \
+                if self.verify else None
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'InvalidRange':
+                raise IOError(DOWNLOAD_ERROR)
+            # Ranged GETs of empty objects fail.
+            size, probe, header_length, expected = 0, b'', None, None
+        shape, dtype, fortran_order, offset = array_layout(probe[:header_length] if header_length else b'', size, dtype)
+        array, view = empty_array(shape, dtype, fortran_order)
+        if len(view) != size - offset:
+            raise ValueError("%s has %d bytes of data, but its header describes %d" % (path, size - offset, len(view)))
+        head = probe[offset:offset + len(view)]
+        view[:len(head)] = head
+        ranges = part_ranges(size, self.part_size, start=offset + len(head))
+        for attempt in range(DEFAULT_CHECKSUM_RETRIES + 1):
+            try:
+                transfer.fetch_into(view, ranges, offset)
+            except ClientError:
+                raise IOError(DOWNLOAD_ERROR)
+            expected = resolved(expected)
+            if expected is None:
+                break
+            checksum = StreamingChecksum(expected[0], expected[2])
+            checksum.update(None, 0, probe[:offset])
+            checksum.update(None, offset, view)
+            digest = checksum.result(None, size)
+            if digest == expected[1]:
+                break
+            if attempt == DEFAULT_CHECKSUM_RETRIES:
+                raise ChecksumMismatch('%s checksum of %s is %s, expected %s' % (expected[0], path, digest, expected[1]))
+            self._count('checksum_retries')
+            # The bytes that came with the header may be the corrupt ones.
+            ranges = part_ranges(size, self.part_size, start=offset)
+        return array
+
+    def list_prefix(self, path):
+        """
+        List every object under path ('<bucket>/<prefix>') with one paginated list_objects_v2 call and keep the listing for listing_ttl seconds.
+        Until then, opens of objects in the listing are validated against its ETag and size without any request to S3: cached copies
+        are used if they match, and objects that have changed are downloaded without a conditional request.
+        Returns a dict mapping each key to its {'ETag', 'ContentLength', 'LastModified'}.
+        """
+        bucket, prefix = split_path(path)
+        return self._listings.list(self.s3, bucket, prefix)
+
+    def sync(self, prefix, dest=None, workers=DEFAULT_MAX_CONCURRENCY, delete=False):
+        """
+        Mirror every object under prefix ('<bucket>/<prefix>') into a local directory, downloading only objects that are new or have changed.
+        Objects are compared with the directory's cache index by ETag and size, using one listing of the prefix (see list_prefix()).
+        Parameters:
+        - prefix: '<bucket>/<prefix>' to mirror. Objects are stored at <dest>/<key>, as in the download cache.
+        - dest: directory to mirror into. Default: dir, so the mirror doubles as the download cache.
+        - workers: maximum number of objects to download at once. Default: 10.
+        - delete: Remove local copies of objects under prefix that no longer exist on S3. Default: False.
+        Returns a dict with the number of objects 'downloaded', 'skipped' (already up to date) and 'deleted', and the 'bytes' transferred.
+        """
+        dest = dest or self.dir
+        if not dest:
+            raise ValueError("sync() requires a destination directory (dest or dir)")
+        index = self._index if dest == self.dir else CacheIndex(dest)
+        bucket, key_prefix = split_path(prefix)
+        listing = self.list_prefix(prefix)
+        summary = Counter(downloaded=0, skipped=0, deleted=0, bytes=0)
+        changed = []
+        for key, head in listing.items():
+            if key.endswith('/'):
+                # Zero-byte "directory" placeholders.
+                continue
+            entry = index.get(key)
+            if entry is not None and entry['blocks'] is None and entry['etag'] == head['ETag'] \
+                    and entry['size'] == head['ContentLength'] and os.path.isfile(os.path.join(dest, key)):
+                summary['skipped'] += 1
+            else:
+                changed.append(key)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for size in pool.map(lambda key: self._sync_one(bucket, key, dest, index), changed):
+                summary['downloaded'] += 1
+                summary['bytes'] += size
+        if delete:
+            for key in index.keys(bucket, key_prefix):
+                # Files decompressed while downloading are cached under their object's key plus DECOMPRESSED_SUFFIX.
+                source = key[:-len(DECOMPRESSED_SUFFIX)] if key.endswith(DECOMPRESSED_SUFFIX) else key
+                if key not in listing and source not in listing:
+                    with self._open_lock:
+                        if dest == self.dir and self._open_keys[key]:
+                            continue
+                        _remove(os.path.join(dest, key))
+                        _remove(os.path.join(dest, key) + PART_SUFFIX)
+                        index.remove(key)
+                    summary['deleted'] += 1
+        if dest == self.dir:
+            self.evict()
+        return dict(summary)
+
+    def _sync_one(self, bucket, key, dest, index):
+        if dest != self.dir:
+            return self._sync_download(bucket, key, dest, index)
+        # Mirroring into the download cache: share the download with open()s of the key in this process, and hold its lock
+        # against other processes, as DownloadedS3File._get_file() does.
+        token = (bucket, key, None)
+        while True:
+            flight, leader = self._flights.join(token)
+            if leader:
+                break
+            try:
+                flight.future.result()
+            except Exception:
+                # The other download failed or was cancelled; try again.
+                continue
+            self._flights.opened(flight)
+            return 0
+        lock = FileLock(lock_path(self.dir, key)) if self.lock_downloads else None
+        try:
+            requested = time.time()
+            waited = lock.acquire() if lock is not None else 0
+            # Whoever held the lock may have just downloaded the file for us.
+            entry = index.get(key) if waited else None
+            if entry is not None and entry['blocks'] is None and os.path.isfile(os.path.join(dest, key)) \
+                    and (entry['downloaded_at'] or 0) >= requested:
+                size = 0
+            else:
+                size = self._sync_download(bucket, key, dest, index)
+        except BaseException as e:
+            self._flights.land(flight, error=e)
+            raise
+        finally:
+            if lock is not None:
+                lock.release()
+        self._flights.land(flight, os.path.join(dest, key))
+        return size
+
+    def _sync_download(self, bucket, key, dest, index):
+        local = os.path.join(dest, key)
+        os.makedirs(os.path.dirname(local) or '.', exist_ok=True)
+        transfer = ParallelDownload(self.s3, bucket, key, part_size=self.part_size,
+                                    max_concurrency=self.max_concurrency, buf_size=self.buf_size, verify=self.verify)
+        try:
+            transfer.start()
+            with open(local + PART_SUFFIX, mode='wb+') as f:
+                transfer.run(f.fileno())
+        except ClientError:
+            raise IOError(DOWNLOAD_ERROR)
+        finally:
+            self._count('checksum_retries', transfer.retries)
+        if dest == self.dir:
+            stored = self._install(local + PART_SUFFIX, local)
+        else:
+            # A mirror elsewhere is meant to be read directly, so it's never compressed.
+            os.replace(local + PART_SUFFIX, local)
+            stored = {'physical_size': None, 'compression': None}
+        index.put(key, bucket=bucket, etag=transfer.etag, size=transfer.size, last_modified=_isoformat(transfer.last_modified),
+                  block_size=None, blocks=None, downloaded_at=time.time(), digest=transfer.digest, **stored)
+        index.touch(key)
+        return transfer.size
+
+    def _install(self, part, local):
+        """
+        Move the complete download at part into place at local, compressing it on the way if cache_compression is set.
+        Returns the physical_size and compression fields of its index entry.
+        """
+        if not self.cache_compression:
+            os.replace(part, local)
+            return {'physical_size': os.path.getsize(local), 'compression': None}
+        fd, compressed = tempfile.mkstemp(dir=os.path.dirname(local), prefix='.', suffix=PART_SUFFIX)
+        try:
+            with os.fdopen(fd, mode='wb') as out:
+                physical_size = compress_file(part, out, self.cache_compression_level, self.cache_frame_size)
+            os.replace(compressed, local)
+        except BaseException:
+            _remove(compressed)
+            raise
+        # Anything still reading the uncompressed download keeps its open file.
+        _remove(part)
+        return {'physical_size': physical_size, 'compression': self.cache_compression}
+
+    def evict(self, max_bytes=None):
+        """
+        Evict cached files, in eviction_policy order, until the cache holds at most max_bytes (default: max_cache_bytes).
+        Files open in this process are skipped, and so are files that another process is downloading (with lock_downloads, whose
+        lock it holds). Returns the number of bytes freed.
+        """
+        max_bytes = self.max_cache_bytes if max_bytes is None else max_bytes
+        if self._index is None or max_bytes is None:
+            return 0
+        excess = self._index.total_size() - max_bytes
+        freed = 0
+        if excess <= 0:
+            return freed
+        for key, size in self._index.eviction_candidates(self.eviction_policy):
+            if freed >= excess:
+                break
+            with self._open_lock:
+                if self._open_keys[key]:
+                    continue
+                lock = FileLock(lock_path(self.dir, key)) if self.lock_downloads else None
+                if lock is not None and not lock.try_acquire():
+                    # Another process is downloading it into <key>.part right now.
+                    continue
+                try:
+                    self._demote(0, key)
+                    _remove(os.path.join(self.dir, key))
+                    _remove(os.path.join(self.dir, key) + PART_SUFFIX)
+                    self._index.remove(key)
+                    self._prefetched.discard(key)
+                finally:
+                    if lock is not None:
+                        lock.release()
+            freed += size or 0
+        return freed
+
+    def tier_stats(self):
+        """
+        Return a dict for each cache tier, fastest first, with its hits, misses, current size in bytes and max_bytes.
+        The in-memory tier (if memory_cache_bytes is set) is named 'memory'; the others are named after their directories.
+        """
+        stats = []
+        if self._memory is not None:
+            stats.append({'tier': 'memory', 'hits': self.metrics['memory_hits'], 'misses': self.metrics['memory_misses'],
+                          'size': self._memory.size, 'max_bytes': self._memory.max_bytes})
+        for tier in self._tiers:
+            stats.append({'tier': tier.dir, 'hits': tier.hits, 'misses': tier.misses,
+                          'size': tier.index.total_size(), 'max_bytes': tier.max_bytes})
+        return stats
+
+    def stats(self):
+        """
+        Return aggregate statistics of every open so far: the number of opens, hits and misses, opens per source, bytes downloaded,
+        checksum retries, and histograms (cumulative (upper bound, count) buckets, sum and count) of ttfb_seconds, open_seconds,
+        downloaded_bytes, throughput_bytes_per_second and disk_write_seconds. Also includes metrics and tier_stats().
+        """
+        stats = self._stats.as_dict()
+        stats['metrics'] = dict(self.metrics)
+        stats['tiers'] = self.tier_stats()
+        return stats
+
+    def prometheus(self, prefix='s3fs_download'):
+        """
+        Return stats() and metrics in the Prometheus text exposition format, e.g. to serve from a /metrics endpoint.
+        """
+        return self._stats.prometheus(self.metrics, prefix)
+
+    def _report(self, event):
+        self._stats.record(event)
+        if self.on_open is not None:
+            self.on_open(event)
+
+    def _promote(self, key):
+        """
+        Copy key into dir from the fastest lower tier that has it. Returns that tier's directory, or None if no tier has it.
+        """
+        for tier in self._tiers[1:]:
+            entry = tier.lookup(key)
+            if entry is not None:
+                try:
+                    self._tiers[0].store(key, tier.path(key), entry)
+                except FileNotFoundError:
+                    # Another node sharing the tier evicted it since the lookup.
+                    continue
+                tier.index.touch(key)
+                return tier.dir
+        return None
+
+    def _demote(self, level, key):
+        """
+        Copy key from tier level into the next tier down, unless that tier already holds the same version,
+        then make room in that tier. Partial downloads are never demoted.
+        """
+        if level + 1 >= len(self._tiers):
+            return
+        tier, lower = self._tiers[level], self._tiers[level + 1]
+        entry = tier.index.get(key)
+        if entry is None or entry['blocks'] is not None or not os.path.isfile(tier.path(key)):
+            return
+        if not lower.holds(key, entry['etag']):
+            lower.store(key, tier.path(key), entry)
+        self._evict_tier(level + 1)
+
+    def _evict_tier(self, level):
+        tier = self._tiers[level]
+        if tier.max_bytes is None:
+            return
+        excess = tier.index.total_size() - tier.max_bytes
+        for key, size in tier.index.eviction_candidates(self.eviction_policy):
+            if excess <= 0:
+                break
+            self._demote(level, key)
+            tier.discard(key)
+            excess -= size or 0
+
+    def _count(self, name, value=1):
+        with self._metrics_lock:
+            self.metrics[name] += value
+
+    def _acquire(self, key):
+        with self._open_lock:
+            self._open_keys[key] += 1
+
+    def _release(self, key):
+        with self._open_lock:
+            self._open_keys[key] -= 1
+            if self._open_keys[key] <= 0:
+                del self._open_keys[key]
+
+    def _expand_paths(self, paths):
+        if isinstance(paths, str):
+            paths = [paths]
+        expanded = []
+        for path in paths:
+            if any(c in path for c in '*?['):
+                expanded.extend(p for p in self.glob(path) if self.isfile(p))
+            else:
+                expanded.append(path)
+        return expanded
 
 class DownloadedS3File(S3File):
     """
@@ -32,9 +534,12 @@ class DownloadedS3File(S3File):
     - s3: an S3Downloader class.
     - path: <bucket>/<key> path of the file on S3.
     - mode: file read mode. Currently, the only choice is 'rb'.
-    - buf_size: size of chunk to read from S3 before writing to disk. Default: 256MB. Decrease if you're running out of RAM.
+    - buf_size: size of chunk to read from S3 before writing to disk, or 'auto' to adapt it to the download's throughput.
+      Default: 256MB, capped at the downloader's part_size. Decrease if you're running out of RAM.
+    - decompress: 'gzip', 'bz2', 'zstd' or 'lz4' to decompress the object while downloading it. The decompressed file is cached at
+      <dir>/<key>.decompressed, and reads, seeks and sizes refer to it. Default: None.
     """
-    def __init__(self, s3, path, mode='rb', buf_size = DEFAULT_BUFFER_SIZE, s3_additional_kwargs=None):
+    def __init__(self, s3, path, mode='rb', buf_size = DEFAULT_BUFFER_SIZE, s3_additional_kwargs=None, decompress=None):
        # The goal here is to wrap the S3File API as much as possible. 
        # Including the mode parameter may be useful for backward compatibility--even though it's currently meaningless, some people's code may specify mode='rb' explicitly.
        # Thus, the API would break if the mode parameter was not included.
@@ -46,55 +551,306 @@ class DownloadedS3File(S3File):
         self.mode = mode
         self.path = path
         self.bucket, self.key = split_path(path)
+        self.codec = decompress
+        # Where the local copy lives, in dir and in the cache index.
+        self.cache_key = self.key + DECOMPRESSED_SUFFIX if decompress else self.key
         self.s3_additional_kwargs = s3_additional_kwargs or {}
-        self.buf_size = DEFAULT_BUFFER_SIZE
+        self.buf_size = buf_size
         self.closed = False
         self._file = None
         self._tmp = None
         self._downloaded = False
+        self._mmap = None
+        self._buffer = None
+        self._progress = None
+        self._thread = None
+        self._pos = 0
+        self._iteration = None
+        self._line_buffer = b''
+        self._line_start = 0
+        self._size = None
+        self._ranged = False
+        self._window_start = 0
+        self._window = b''
+        self._blocks = None
+        self._etag = None
+        self._manifest = None
+        self._manifest_lock = threading.Lock()
+        self._lock = None
+        self._flight = None
+        self._data = None
+        self._source = None
+        self._transfer = None
+        self._started = None
+        self.s3._acquire(self.cache_key)
         
         if not self.s3.lazy:
-            self._file = self._get_file()         
+            try:
+                self._file = self._get_file()
+            except BaseException:
+                self.close()
+                raise
             self._downloaded = True
 
     def read(self, length=-1, force_refresh=False):
         """
         Read downloaded file from cache. Will download if lazy loading is enabled.
+        If seek() has been called on a lazy file that hasn't been downloaded yet, only the requested byte range is fetched.
         """ 
         # TODO blazingly fast reads: http://rabexc.org/posts/io-performance-in-python
-        if not self._file:
-            self._file = self._get_file()
-        if self._file.closed:
-            raise IOError("Cache closed")
+        if self._iteration is not None:
+            self._settle()
+        if length is None or length < 0:
+            length = -1
+        if self._file is None and not self.codec:
+            self._open_cached()
+        if self._file is None and self.s3.block_size and self.s3.dir and not self.codec and self._open_blocks() and length != -1:
+            return self._read_blocks(length)
+        if self._ranged and length != -1:
+            return self._read_range(length)
+        f = self._ensure_file()
+        if self._progress is not None:
+            return self._stream_read(length)
+        if self.s3.read_mode == 'mmap':
+            buf = self.as_buffer()
+            start = self._pos
+            end = len(buf) if length == -1 else min(start + length, len(buf))
+            self._pos = max(start, end)
+            return buf[start:end]
 
-        with self._file as f:
-            if length == -1:
-                return f.read()
-            else:
-                return f.read(length)
+        f.seek(self._pos)
+        data = f.read() if length == -1 else f.read(length)
+        self._pos += len(data)
+        return data
+
+    def readinto(self, b):
+        """
+        Read up to len(b) bytes into the writable buffer b. Returns the number of bytes read.
+        """
+        if self._iteration is not None:
+            self._settle()
+        view = memoryview(b).cast('B')
+        if self._file is None or self._ranged or self._progress is not None or self.s3.read_mode == 'mmap':
+            data = self.read(len(view))
+            view[:len(data)] = data
+            return len(data)
+        f = self._ensure_file()
+        f.seek(self._pos)
+        n = f.readinto(view) or 0
+        self._pos += n
+        return n
 
     def readline(self):
         """
         Read a line of the downloaded file from cache. Will download if lazy loading is enabled.
+        Lines are cut from a large block kept from earlier calls, so most calls don't touch the underlying file.
         """
-        if not self._file:
-            self._file = self._get_file()
-        if self._file.closed:
-            raise IOError("Cache closed")
+        if self._iteration is not None:
+            self._settle()
+        i = self._pos - self._line_start
+        end = self._line_buffer.find(b'\n', i) + 1 if i >= 0 else 0
+        if end:
+            self._pos = self._line_start + end
+            return self._line_buffer[i:end]
+        f = self._ensure_file()
+        if self._progress is not None:
+            return self._stream_readline()
+        if self.s3.read_mode == 'mmap':
+            buf = self.as_buffer()
+            start = self._pos
+            source = self._mmap if self._mmap is not None else self._data
+            end = source.find(b'\n', start) + 1 if source is not None else 0
+            self._pos = end or max(len(buf), start)
+            return bytes(buf[start:self._pos])
 
-        return self._file.readline()
+        f.seek(self._pos)
+        block = f.read(DEFAULT_LINE_BLOCK_SIZE)
+        end = block.find(b'\n') + 1
+        if end or len(block) < DEFAULT_LINE_BLOCK_SIZE:
+            self._line_buffer, self._line_start = block, self._pos
+            line = block[:end] if end else block
+        else:
+            # The line is longer than a block.
+            f.seek(self._pos)
+            line = f.readline()
+        self._pos += len(line)
+        return line
 
-    def readlines(self):
+    def __iter__(self):
         """
-        Read all lines of the downloaded file from cache. Will download if lazy loading is enabled.
+        Iterate over the lines of the file from the current position. Lines are cut from large blocks in C (see _line_blocks())
+        and handed out without any Python code per line, which is several times faster than calling readline() in a loop.
+        tell() is exact between lines, and after breaking out of the loop, reads, seeks and new loops continue after the last
+        line it yielded. As with a regular file, reads and seeks inside the loop move it too: it goes on from wherever they leave
+        the position.
         """
-        if not self._file:
-            self._file = self._get_file
-        if self._file.closed:
-            raise IOError("Cache closed")
+        while True:
+            for start, lines in self._line_blocks():
+                it = iter(lines)
+                # [offset after the lines counted so far, number of lines counted, lines, iterator over them]; see _iterated().
+                iteration = self._iteration = [start, 0, lines, it]
+                yield from it
+                if self._iteration is not iteration:
+                    # A read or seek inside the loop settled it, cutting the block short; start again from the new position.
+                    break
+                self._iteration = None
+            else:
+                return
+
+    def iter_chunks(self, size=DEFAULT_LINE_BLOCK_SIZE, delimiter=None):
+        """
+        Yield the rest of the file as read-only memoryviews of size bytes (the last one may be shorter), for parsers that work on
+        large blocks rather than lines. Views stay valid after the next one is yielded. In streaming mode, each chunk is yielded as
+        soon as it has downloaded.
+        Parameters:
+        - size: bytes per chunk. Default: 1MB.
+        - delimiter: if given (e.g. b'\\n'), end each chunk just after the last delimiter in it, so no record is split between chunks.
+          Chunks are then about size bytes, and longer if a single record is. Default: None.
+        """
+        if delimiter is not None:
+            for start, block in self._records(size, delimiter):
+                yield memoryview(block)
+            return
+        while True:
+            chunk = self.read(size)
+            if not chunk:
+                return
+            yield memoryview(chunk)
+
+    def iter_line_batches(self, n):
+        """
+        Yield the rest of the file's lines in lists of n (the last one may be shorter), newlines included. Lines are cut from large
+        blocks as in iteration, so there is no Python call per line. After each batch, the position is just after its last line.
+        Works in streaming mode, yielding each batch once its lines have downloaded.
+        """
+        if n < 1:
+            raise ValueError("n must be at least 1")
+        batch = []
+        for start, lines in self._line_blocks():
+            offset, i = start, 0
+            while len(batch) + len(lines) - i >= n:
+                taken = lines[i:i + n - len(batch)]
+                i += len(taken)
+                offset += sum(map(len, taken))
+                batch.extend(taken)
+                self._pos = offset
+                yield batch
+                batch = []
+            batch.extend(lines[i:])
+        if batch:
+            yield batch
+
+    def _iterated(self):
+        """
+        Return the offset just after the last line __iter__ yielded, from how far it has got through its current block.
+        """
+        iteration = self._iteration
+        offset, counted, lines, it = iteration
+        consumed = len(lines) - it.__length_hint__()
+        if consumed > counted:
+            offset += sum(map(len, lines[counted:consumed]))
+            iteration[0], iteration[1] = offset, consumed
+        return offset
+
+    def _settle(self):
+        # Catch _pos up with a loop over the file that was left part of the way through a block, and drop the block's remaining
+        # lines so that a loop that's still running doesn't yield them after the read or seek that settled it.
+        self._pos = self._iterated()
+        offset, counted, lines, it = self._iteration
+        del lines[counted:]
+        self._iteration = None
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        """
+        Move to a new position in the file and return it. whence is io.SEEK_SET, io.SEEK_CUR or io.SEEK_END, as for regular files.
+        On a lazy file that hasn't been downloaded, this switches to fetching only the byte ranges that are read.
+        """
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        if self._iteration is not None:
+            self._settle()
+        if self._file is None and not self.codec:
+            self._open_cached()
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self._get_size() + offset
+        else:
+            raise ValueError("Invalid whence (%r, should be 0, 1 or 2)" % whence)
+        if pos < 0:
+            raise ValueError("Negative seek position %d" % pos)
+        if self._file is None and not self.codec:
+            self._ranged = True
+        self._pos = pos
+        return pos
+
+    def tell(self):
+        """
+        Return the current position in the file.
+        """
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        if self._iteration is not None:
+            return self._iterated()
+        return self._pos
+
+    def readable(self):
+        return not self.closed
+
+    def seekable(self):
+        return not self.closed
+
+    def writable(self):
+        return False
 
-        return self._file.readlines()
+    def readlines(self, hint=-1):
+        """
+        Read the remaining lines of the downloaded file from cache, or lines until their total size reaches hint if it's positive.
+        Will download if lazy loading is enabled.
+        """
+        if self._iteration is not None:
+            self._settle()
+        if hint is None or hint <= 0:
+            lines = []
+            for start, block in self._line_blocks():
+                lines.extend(block)
+            return lines
+        lines, size = [], 0
+        for line in self:
+            lines.append(line)
+            size += len(line)
+            if size >= hint:
+                break
+        return lines
     
+    def as_buffer(self):
+        """
+        Return the whole file as a read-only memoryview of a memory map of the local copy, so that no copy of the data is made.
+        For example, np.frombuffer(f.as_buffer(), dtype=np.float32) wraps the file without loading it into memory.
+        Will download if lazy loading is enabled. The view should not be used after the file is closed.
+        """
+        if self._buffer is None:
+            f = self._ensure_file()
+            if self._progress is not None:
+                self._wait()
+            if isinstance(f, SeekableZstdFile):
+                # There's nothing on disk to map.
+                f.seek(0)
+                self._data = f.read()
+            if self._data is not None:
+                self._buffer = memoryview(self._data)
+                return self._buffer
+            try:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files can't be mapped.
+                self._buffer = memoryview(b'')
+            else:
+                self._buffer = memoryview(self._mmap)
+        return self._buffer
+
     def write(self, *args, **kwargs):
         """
         Not implemented.
@@ -109,42 +865,640 @@ class DownloadedS3File(S3File):
 
     def close(self):
         """
-        Close cache file.
+        Close cache file. Stops the download if it is still streaming.
         """
+        if self._thread is not None:
+            self._progress.cancel()
+            self._thread.join()
+            self._thread = None
+        if self._mmap is not None:
+            try:
+                self._buffer.release()
+                self._mmap.close()
+            except BufferError:
+                # Something (e.g. a NumPy array) still references the map; it's unmapped once that is garbage collected.
+                pass
+            self._mmap = None
+        self._buffer = None
+        self._line_buffer = b''
+        if self._blocks is not None:
+            self._blocks.close()
+            self._blocks = None
         if self._file:
             self._file.close()
+        if not self.closed:
+            self.s3._release(self.cache_key)
         self.closed = True
         
     def _get_tmp(self):
         if self.s3.dir:
-            dir = os.path.join(self.s3.dir, os.sep.join(self.key.split(os.sep)[0:-1]))
+            dir = os.path.join(self.s3.dir, os.sep.join(self.cache_key.split(os.sep)[0:-1]))
             if not os.path.isdir(dir):
                 os.makedirs(dir, exist_ok=True)
-            return open(os.path.join(self.s3.dir, self.key), mode='wb+')
+            return open(os.path.join(self.s3.dir, self.cache_key) + PART_SUFFIX, mode='wb+')
+        else:
+            # Named, so that other opens sharing this download can open it too. Removed once they all have.
+            return tempfile.NamedTemporaryFile(mode='wb+', delete=False)
+
+    def _ensure_file(self):
+        if self.closed:
+            raise IOError("Cache closed")
+        if not self._file:
+            if self.s3.block_size and self.s3.dir and not self.codec:
+                # Reuse any blocks cached by earlier opens.
+                self._open_blocks()
+            if not self._file:
+                self._file = self._get_file()
+            self._ranged = False
+            self._window = b''
+        if self._file.closed:
+            raise IOError("Cache closed")
+        return self._file
+
+    def _open_cached(self):
+        """
+        Open the local copy if _get_file() would serve it without asking S3, rather than fetching ranges or blocks of a file
+        that's already here. Returns whether it did.
+        """
+        if not self.s3.dir or self._blocks is not None:
+            return False
+        if not (self.cache_key in self.s3._prefetched or (self.s3.use_cache and not self.s3.validate_cache)):
+            return False
+        if not os.path.isfile(os.path.join(self.s3.dir, self.cache_key)):
+            return False
+        self._file = self._get_file()
+        self._downloaded = True
+        self._ranged = False
+        self._window = b''
+        return True
+
+    def _get_size(self):
+        if self._size is None:
+            if self._progress is not None:
+                self._size = self._progress.size
+            elif self._file or self.codec:
+                # The decompressed size is only known once it's downloaded. Seeking also works for compressed cached files.
+                self._size = self._ensure_file().seek(0, io.SEEK_END)
+            else:
+                head = self._head()
+                self._size = head['ContentLength']
+                self._etag = self._etag or head['ETag']
+        return self._size
+
+    def _head(self):
+        """
+        Return the object's ETag, ContentLength and LastModified, from a listing made by list_prefix() if there is a fresh one, or with a HEAD.
+        """
+        head = self.s3._listings.get(self.bucket, self.key)
+        if head is not None:
+            self.s3._count('listing_hits')
+            return head
+        try:
+            return self.s3.s3.head_object(Bucket=self.bucket, Key=self.key)
+        except ClientError:
+            raise IOError(DOWNLOAD_ERROR)
+
+    def _read_range(self, length):
+        if self.closed:
+            raise IOError("Cache closed")
+        start, end = self._pos, self._pos + length
+        window_end = self._window_start + len(self._window)
+        complete = self._size is not None and window_end >= self._size
+        if not (self._window_start <= start and (end <= window_end or complete)):
+            fetch_end = max(end, start + self.s3.range_readahead)
+            if self._size is not None:
+                fetch_end = min(fetch_end, self._size)
+            self._window_start = start
+            self._window = self._fetch_range(start, fetch_end) if fetch_end > start else b''
+        data = self._window[start - self._window_start:end - self._window_start]
+        self._pos += len(data)
+        return data
+
+    def _fetch_range(self, start, end):
+        # Every range comes from the version the first one (or the HEAD) saw, so e.g. a footer and the data it describes match.
+        kwargs = {'IfMatch': self._etag} if self._etag else {}
+        try:
+            resp = self.s3.s3.get_object(Bucket=self.bucket, Key=self.key, Range='bytes=%d-%d' % (start, end - 1), **kwargs)
+        except ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code == 'InvalidRange':
+                # Reading at or past the end of the file.
+                return b''
+            if code in ('412', 'PreconditionFailed'):
+                raise IOError("%s changed on S3 while it was being read" % self.path)
+            raise IOError(DOWNLOAD_ERROR)
+        self._size = _object_size(resp)
+        self._etag = resp['ETag']
+        return resp['Body'].read()
+
+    def _open_blocks(self):
+        """
+        Open this file's sparse block file, validating any blocks cached by earlier opens against the object's ETag with one HEAD.
+        Returns None if a complete, up-to-date copy is already cached; it is opened as self._file instead.
+        """
+        if self._blocks is not None or self._file:
+            return self._blocks
+        head = self._head()
+        index = self.s3._index
+        local = os.path.join(self.s3.dir, self.cache_key)
+        entry = index.get(self.cache_key)
+        current = entry is not None and entry['etag'] == head['ETag'] and entry['size'] == head['ContentLength']
+        if current and entry['blocks'] is None and os.path.isfile(local):
+            index.touch(self.cache_key)
+            self._file = self._open_local(local, entry)
+            self._downloaded = True
+            return None
+        if current and entry['blocks'] is not None and entry['block_size'] == self.s3.block_size:
+            bitmap = entry['blocks']
         else:
-            return tempfile.TemporaryFile(mode='wb+')
+            bitmap = None
+            _remove(local + PART_SUFFIX)
+            index.put(self.cache_key, bucket=self.bucket, etag=head['ETag'], size=head['ContentLength'],
+                      last_modified=_isoformat(head.get('LastModified')), block_size=self.s3.block_size, blocks=b'',
+                      physical_size=None, compression=None)
+        index.touch(self.cache_key)
+        self._etag = head['ETag']
+        self._size = head['ContentLength']
+        self._blocks = BlockFile(local + PART_SUFFIX, self._size, self.s3.block_size, bitmap)
+        return self._blocks
+
+    def _read_blocks(self, length):
+        start = self._pos
+        end = min(start + length, self._blocks.size)
+        if end <= start:
+            return b''
+        self._fetch_blocks(self._blocks.missing_ranges(start, end, max_length=self.s3.part_size))
+        data = self._blocks.read(start, end)
+        self._pos += len(data)
+        return data
+
+    def _fetch_blocks(self, ranges):
+        if not ranges:
+            return
+        transfer = ParallelDownload(self.s3.s3, self.bucket, self.key, part_size=self.s3.part_size,
+                                    max_concurrency=self.s3.max_concurrency, buf_size=self.buf_size)
+        transfer.etag = self._etag
+        try:
+            transfer.fetch_ranges(self._blocks.fd, ranges)
+        except ClientError:
+            raise IOError(DOWNLOAD_ERROR)
+        for start, end in ranges:
+            self._blocks.mark(start, end)
+        self.s3._index.put(self.cache_key, blocks=bytes(self._blocks.bitmap))
+
+    def _complete_blocks(self):
+        """
+        Fetch every missing block, then move the sparse file into place as a complete cached copy.
+        """
+        self._fetch_blocks(self._blocks.missing_ranges(max_length=self.s3.part_size))
+        self._blocks.close()
+        local = os.path.join(self.s3.dir, self.cache_key)
+        f = open(self._blocks.path, mode='rb')
+        stored = self.s3._install(self._blocks.path, local)
+        self._blocks = None
+        self.s3._index.put(self.cache_key, block_size=None, blocks=None, downloaded_at=time.time(), **stored)
+        self._source = 's3'
+        self._downloaded = True
+        self.s3.evict()
+        return f
+
+    def _wait(self, offset=None):
+        try:
+            return self._progress.wait(offset)
+        except ClientError:
+            raise IOError(DOWNLOAD_ERROR)
+
+    def _stream_read(self, length):
+        available = self._wait(None if length == -1 else self._pos + length)
+        end = available if length == -1 else min(self._pos + length, available)
+        data = os.pread(self._file.fileno(), max(end - self._pos, 0), self._pos)
+        self._pos += len(data)
+        return data
+
+    def _stream_readline(self):
+        # As in readline(), the block a line is cut from is kept for the calls that follow; it ends at high_water, since
+        # nothing past that has landed yet.
+        line = []
+        while True:
+            available = self._wait(self._pos + 1)
+            if available <= self._pos:
+                break
+            block = os.pread(self._file.fileno(), min(available - self._pos, DEFAULT_LINE_BLOCK_SIZE), self._pos)
+            end = block.find(b'\n') + 1
+            if end:
+                self._line_buffer, self._line_start = block, self._pos
+                line.append(block[:end])
+                self._pos += end
+                break
+            line.append(block)
+            self._pos += len(block)
+        return b''.join(line)
+
+    def _line_blocks(self, block_size=DEFAULT_LINE_BLOCK_SIZE):
+        """
+        Read the file from the current position in blocks of whole lines (see _records()), and yield (offset, lines) for each:
+        the lines in the block, newlines included, and the offset of the first.
+        """
+        for start, block in self._records(block_size, b'\n'):
+            yield start, _split_lines(block)
+
+    def _records(self, block_size, delimiter):
+        """
+        Read the file from the current position in blocks of about block_size bytes that end just after a delimiter (or at the end of
+        the file), and yield (offset, block) for each. The partial record at the end of a read is read again as the start of the next
+        block; a record longer than block_size is read in as many reads as it takes. Between blocks, the position is just after the
+        last one yielded, even if the caller moved it.
+        """
+        if self._iteration is not None:
+            self._settle()
+        start = self._pos
+        while True:
+            self._pos = start
+            block = self.read(block_size)
+            if not block:
+                return
+            block = bytes(block)
+            end = block.rfind(delimiter) + len(delimiter)
+            while end < len(delimiter):
+                more = self.read(block_size)
+                if not more:
+                    end = len(block)
+                    break
+                searched = max(len(block) - len(delimiter) + 1, 0)
+                block += more
+                end = block.find(delimiter, searched) + len(delimiter)
+            self._pos = start + end
+            yield start, block if end == len(block) else block[:end]
+            start += end
 
-    def _download(self):
+    def _download(self, etag=None):
+        """
+        Download the file. If etag is given and the object on S3 still has that ETag, nothing is downloaded and False is returned.
+        With a download directory, data is written to <dir>/<key>.part and the parts that are complete are recorded in the cache index,
+        so an interrupted download resumes where it left off. The file is only moved to <dir>/<key> once it is complete.
+        In streaming mode, only the first part is fetched before returning; the rest downloads on a background thread.
+        """
+        if self.codec:
+            return self._download_decompressed(etag)
+        ranges = None
         try:
+            transfer = ParallelDownload(self.s3.s3, self.bucket, self.key, part_size=self.s3.part_size,
+                                        max_concurrency=self.s3.max_concurrency, buf_size=self.buf_size,
+                                        if_none_match=etag, verify=self.s3.verify)
+            self._transfer = transfer
+            if not transfer.start():
+                return False
+            self._etag = transfer.etag
+            if self.s3._index is not None:
+                ranges = self._prepare_part(transfer)
+            else:
+                self._tmp = self._get_tmp()
+        except ClientError:
+            raise IOError(DOWNLOAD_ERROR)
+        if self.s3.streaming:
+            self._progress = transfer.progress = DownloadProgress(transfer.size)
+            for start, end in self._manifest.present_ranges() if self._manifest else []:
+                self._progress.advance(start, end)
+            # The thread reports the download when it finishes, which can be before this returns, so count the miss first.
+            self._record_hit(False)
+            self._thread = threading.Thread(target=self._finish_download, args=(transfer, ranges), daemon=True)
+            self._thread.start()
+        else:
+            self._finish_download(transfer, ranges)
+        return True
+
+    def _download_decompressed(self, etag=None):
+        """
+        Download the object with one sequential GET, decompressing it into <dir>/<key>.decompressed.part on the way, and then move that to
+        <dir>/<key>.decompressed. The compressed bytes are checksummed as they arrive, as in ParallelDownload. Returns False if the object
+        still has ETag etag.
+        """
+        kwargs = {'IfNoneMatch': etag} if etag else {}
+        chunk_size = self.s3.part_size if self.buf_size == 'auto' else min(self.buf_size, self.s3.part_size)
+        for attempt in range(DEFAULT_CHECKSUM_RETRIES + 1):
+            try:
+                resp = self.s3.s3.get_object(Bucket=self.bucket, Key=self.key, **kwargs)
+                expected = expected_checksum(self.s3.s3, self.bucket, self.key, resp, max_workers=self.s3.max_concurrency) \
+                    if self.s3.verify else None
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') in ('304', 'NotModified'):
+                    return False
+                raise IOError(DOWNLOAD_ERROR)
+            checksum = StreamingChecksum(expected[0], expected[2]) if expected else None
+            decoder = Decoder(self.codec)
+            if self._tmp is not None:
+                # A retry after a checksum mismatch starts over.
+                self._tmp.close()
+                if not self.s3.dir:
+                    _remove(self._tmp.name)
             self._tmp = self._get_tmp()
-            obj = self.s3.s3.get_object(Bucket=self.bucket, Key=self.key)['Body']
-            data = obj.read(amt=self.buf_size)
-            while data:
-                self._tmp.write(data)
-                data = obj.read(amt=self.buf_size)
+            size = 0
+            with resp['Body'] as body:
+                for data in iter(lambda: body.read(chunk_size), b''):
+                    if checksum is not None:
+                        checksum.update(None, size, data)
+                    size += len(data)
+                    self._tmp.write(decoder.decompress(data))
+            self._tmp.flush()
+            digest = checksum.result(None, size) if checksum is not None else None
+            if digest is None or digest == expected[1]:
+                break
+            if attempt == DEFAULT_CHECKSUM_RETRIES:
+                raise ChecksumMismatch('%s checksum of %s/%s is %s, expected %s' % (expected[0], self.bucket, self.key, digest, expected[1]))
+            self.s3._count('checksum_retries')
+        self._etag = resp['ETag']
+        index = self.s3._index
+        if index is not None:
+            local = os.path.join(self.s3.dir, self.cache_key)
+            stored = self.s3._install(local + PART_SUFFIX, local)
+            index.put(self.cache_key, bucket=self.bucket, etag=resp['ETag'], size=resp['ContentLength'],
+                      last_modified=_isoformat(resp.get('LastModified')), block_size=None, blocks=None,
+                      downloaded_at=time.time(), digest='%s:%s' % (expected[0], digest) if digest else None, **stored)
+            index.touch(self.cache_key)
+            self.s3.evict()
+        return True
+
+    def _prepare_part(self, transfer):
+        """
+        Open <dir>/<key>.part for transfer, resuming a previous partial download of the same object version if there is one.
+        Returns the byte ranges that still need to be fetched.
+        """
+        index = self.s3._index
+        part = os.path.join(self.s3.dir, self.cache_key) + PART_SUFFIX
+        entry = index.get(self.cache_key)
+        if entry is not None and entry['blocks'] is not None and entry['etag'] == transfer.etag \
+                and entry['size'] == transfer.size and os.path.isfile(part):
+            self._manifest = BlockMap(transfer.size, entry['block_size'], entry['blocks'])
+            self._tmp = open(part, mode='rb+')
+        else:
+            self._manifest = BlockMap(transfer.size, self.s3.part_size)
+            index.put(self.cache_key, bucket=self.bucket, etag=transfer.etag, size=transfer.size,
+                      last_modified=_isoformat(transfer.last_modified), block_size=self.s3.part_size,
+                      blocks=bytes(self._manifest.bitmap), physical_size=None, compression=None)
+            # Otherwise it would have never been accessed, and be first in line for eviction.
+            index.touch(self.cache_key)
+            self._tmp = self._get_tmp()
+        transfer.on_range = self._checkpoint
+        return self._manifest.missing_ranges(max_length=self.s3.part_size)
+
+    def _checkpoint(self, start, end):
+        with self._manifest_lock:
+            self._manifest.mark(start, end)
+            self.s3._index.put(self.cache_key, blocks=bytes(self._manifest.bitmap))
+
+    def _finish_download(self, transfer, ranges=None):
+        try:
+            self._run_download(transfer, ranges)
+        finally:
+            if self._thread is not None:
+                self._release_lock()
+                self._land(self._progress.error)
+                if self._progress.error is None:
+                    self._report()
+
+    def _run_download(self, transfer, ranges):
+        index = self.s3._index
+        try:
+            transfer.run(self._tmp.fileno(), ranges)
         except ClientError:
-            raise IOError("Couldn't download file. Verify that your S3 path is valid and that you have appropriate permissions.")
-            
+            if self._progress is None:
+                raise IOError(DOWNLOAD_ERROR)
+            return
+        except BaseException:
+            if self._progress is None:
+                raise
+            # Streaming: the error (or cancellation) was handed to readers through self._progress.
+            return
+        finally:
+            self.s3._count('checksum_retries', transfer.retries)
+        if index is not None:
+            local = os.path.join(self.s3.dir, self.cache_key)
+            stored = self.s3._install(local + PART_SUFFIX, local)
+            index.put(self.cache_key, bucket=self.bucket, etag=transfer.etag, size=transfer.size,
+                      last_modified=_isoformat(transfer.last_modified), block_size=None, blocks=None,
+                      downloaded_at=time.time(), digest=transfer.digest, **stored)
+            index.touch(self.cache_key)
+            self.s3.evict()
+
     def _get_file(self, force_refresh=False):
-        if self.s3.use_cache and os.path.isfile(os.path.join(self.s3.dir, self.key)) and not force_refresh:            
-            return open(os.path.join(self.s3.dir, self.key), mode='rb')
+        """
+        Open the local copy, downloading it if needed. Concurrent opens of the same object in this process share one download:
+        the first becomes its leader, and the others wait for it to finish and then open the file it produced.
+        """
+        self._started = time.monotonic()
+        if self.s3._memory is not None:
+            f = self._get_from_memory(force_refresh)
+            if f is not None:
+                self._report()
+                return f
+        token = (self.bucket, self.cache_key, self.s3_additional_kwargs.get('VersionId'))
+        while True:
+            flight, leader = self.s3._flights.join(token)
+            if leader:
+                break
+            try:
+                f = self._follow(flight)
+                self._report()
+                return f
+            except DownloadCancelled:
+                # The leader was closed before its streaming download finished; start over.
+                continue
+        self._flight = flight
+        try:
+            f = self._get_file_locked(force_refresh)
+        except BaseException as e:
+            self._land(e)
+            raise
+        if self._thread is None:
+            self._land()
+            self._remember(f)
+            self._report()
+        return f
+
+    def _report(self):
+        transfer = self._transfer
+        seconds = time.monotonic() - self._started
+        event = {
+            'path': self.path,
+            'source': self._source or 's3',
+            'hit': self._source != 's3',
+            'seconds': seconds,
+            'ttfb': transfer.ttfb if transfer else None,
+            'bytes': transfer.bytes_transferred if transfer else 0,
+            'retries': transfer.retries if transfer else 0,
+            'disk_write_seconds': transfer.write_seconds if transfer else None,
+        }
+        event['throughput'] = event['bytes'] / seconds if event['bytes'] and seconds > 0 else None
+        self.s3._report(event)
+
+    def _get_from_memory(self, force_refresh=False):
+        """
+        Return a file object over the in-memory copy of the object, or None if there isn't an up-to-date one.
+        """
+        memory = self.s3._memory
+        entry = None if force_refresh else memory.get((self.bucket, self.cache_key))
+        if entry is not None and self.s3.validate_cache:
+            if self._head()['ETag'] != entry[0]:
+                memory.invalidate((self.bucket, self.cache_key))
+                entry = None
+        if entry is None:
+            self.s3._count('memory_misses')
+            return None
+        self.s3._count('memory_hits')
+        self._source = 'memory'
+        self._etag, self._data = entry
+        self._downloaded = True
+        return io.BytesIO(self._data)
+
+    def _remember(self, f):
+        # Keep small objects in memory for later opens, if we know which version of the object we have.
+        if self.s3._memory is None or self._etag is None:
+            return
+        if f.seek(0, io.SEEK_END) > self.s3.memory_cache_max_object:
+            return
+        f.seek(0)
+        self.s3._memory.put((self.bucket, self.cache_key), self._etag, f.read())
+        f.seek(0)
 
+    def _follow(self, flight):
+        path = flight.future.result()
+        try:
+            f = self._open_local(path) if self.s3.dir else open(path, mode='rb')
+        finally:
+            self.s3._flights.opened(flight)
+        if self._blocks is not None:
+            self._blocks.close()
+            self._blocks = None
+        if self.s3._index is not None:
+            self.s3._index.touch(self.cache_key)
+        self.s3._count('shared_downloads')
+        self._source = 'shared'
+        self._downloaded = True
+        return f
+
+    def _land(self, error=None):
+        flight, self._flight = self._flight, None
+        if flight is None:
+            return
+        if self.s3.dir:
+            self.s3._flights.land(flight, os.path.join(self.s3.dir, self.cache_key), error)
         else:
-            if not self._downloaded:
-                self._download()
-                self._downloaded = True
-            self._tmp.seek(0)
-            return self._tmp
+            self.s3._flights.land(flight, self._tmp.name if self._tmp else None, error, temporary=True)
+
+    def _get_file_locked(self, force_refresh=False):
+        """
+        With a download directory, hold the key's file lock while getting the file (until the download finishes, in streaming mode),
+        so concurrent processes download each key only once.
+        """
+        index = self.s3._index
+        if index is None or not self.s3.lock_downloads:
+            return self._get_file_unlocked(force_refresh)
+        lock = FileLock(lock_path(self.s3.dir, self.cache_key))
+        requested = time.time()
+        waited = lock.acquire()
+        try:
+            local = os.path.join(self.s3.dir, self.cache_key)
+            if waited:
+                self.s3._count('lock_waits')
+                self.s3._count('lock_wait_seconds', waited)
+                # Whoever held the lock may have just downloaded the file for us.
+                entry = index.get(self.cache_key)
+                if not force_refresh and entry is not None and entry['blocks'] is None and os.path.isfile(local) \
+                        and (entry['downloaded_at'] or 0) >= requested:
+                    if self._blocks is not None:
+                        self._blocks.close()
+                        self._blocks = None
+                    index.touch(self.cache_key)
+                    self._source = self.s3.dir
+                    self._downloaded = True
+                    return self._open_local(local, entry)
+            # A streaming download's thread releases the lock when it finishes.
+            self._lock = lock
+            f = self._get_file_unlocked(force_refresh)
+        except BaseException:
+            if self._thread is None:
+                lock.release()
+            raise
+        if self._thread is None:
+            self._release_lock()
+        return f
+
+    def _release_lock(self):
+        if self._lock is not None:
+            self._lock.release()
+            self._lock = None
+
+    def _get_file_unlocked(self, force_refresh=False):
+        if self._blocks is not None:
+            return self._complete_blocks()
+        local = os.path.join(self.s3.dir, self.cache_key)
+        etag = None
+        if not force_refresh and self.s3.use_cache and not os.path.isfile(local):
+            self._source = self.s3._promote(self.cache_key)
+            if self._source is not None:
+                self.s3.evict()
+        if not force_refresh and os.path.isfile(local):
+            entry = self.s3._index.get(self.cache_key) if self.s3._index is not None else None
+            if entry is not None and entry['blocks'] is None:
+                self._etag = entry['etag']
+            if self.cache_key in self.s3._prefetched or (self.s3.use_cache and not self.s3.validate_cache):
+                if self.s3._index is not None:
+                    self.s3._index.touch(self.cache_key)
+                self._record_hit(True)
+                return self._open_local(local, entry)
+            if self.s3.use_cache:
+                etag = self._etag
+                listed = self.s3._listings.get(self.bucket, self.key) if etag else None
+                if listed is not None:
+                    self.s3._count('listing_hits')
+                    if listed['ETag'] == etag and listed['ContentLength'] == entry['size']:
+                        self.s3._index.touch(self.cache_key)
+                        self._record_hit(True)
+                        return self._open_local(local, entry)
+                    # Known to have changed, so there's no point in a conditional GET.
+                    etag = None
+
+        if not self._downloaded:
+            if not self._download(etag=etag):
+                self.s3._index.touch(self.cache_key)
+                self._record_hit(True)
+                return self._open_local(local, entry)
+            if self._thread is None:
+                # Streaming downloads recorded their miss before starting.
+                self._record_hit(False)
+            self._downloaded = True
+        self._tmp.seek(0)
+        return self._tmp
+
+    def _open_local(self, path, entry=None):
+        """
+        Open a complete cached copy, decompressing it as it's read if it's stored compressed. entry is its index entry, if already known.
+        """
+        if entry is None and self.s3._index is not None:
+            entry = self.s3._index.get(self.cache_key)
+        if entry is not None and entry['compression'] == 'zstd':
+            return SeekableZstdFile(path)
+        return open(path, mode='rb')
+
+    def _record_hit(self, hit):
+        # Hits and misses of dir, the top disk tier; lower tiers count their own in S3Downloader._promote().
+        # A file promoted from a lower tier keeps that tier as its source.
+        self._source = (self._source or self.s3.dir) if hit else 's3'
+        if self.s3._tiers:
+            self.s3._tiers[0].record(hit)
 
     def _read_only():
         raise NotImplementedError('DownloadedS3File is read-only. Use s3fs.S3File for writes.')
+
+def _split_lines(data):
+    # bytes.splitlines() is fastest, but also splits on \r.
+    if b'\r' not in data:
+        return data.splitlines(True)
+    lines = [line + b'\n' for line in data.split(b'\n')]
+    lines[-1] = lines[-1][:-1]
+    if not lines[-1]:
+        lines.pop()
+    return lines
+
+def _isoformat(timestamp):
+    return timestamp.isoformat() if timestamp is not None else None
@@ -0,0 +1,69 @@
+import os
+import threading
+from concurrent.futures import Future
+
+class Flight(object):
+    """
+    One in-flight download, shared by the leader that performs it and the followers waiting for it.
+    future resolves to the path of the completed local file, or raises the error the download failed with.
+    """
+    def __init__(self, key):
+        self.key = key
+        self.future = Future()
+        self.followers = 0
+        self.temporary = False
+
+class SingleFlight(object):
+    """
+    Lets concurrent opens of the same object within one process share a single download.
+    The first caller to join() a key becomes the leader and downloads the object; later callers wait for its result
+    and open the file it produced.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def join(self, key):
+        """
+        Join the in-flight download for key, starting one if there is none.
+        Returns (flight, leader). If leader is True, the caller must download the object and then call land().
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = Flight(key)
+                return flight, True
+            flight.followers += 1
+            return flight, False
+
+    def land(self, flight, path=None, error=None, temporary=False):
+        """
+        Publish the leader's result: the path of the completed local file, or the error the download failed with.
+        A temporary file is removed once every follower has opened it.
+        """
+        with self._lock:
+            del self._flights[flight.key]
+            flight.temporary = temporary
+            remove = temporary and (error is not None or not flight.followers)
+        if remove and path is not None:
+            _remove(path)
+        if error is not None:
+            flight.future.set_exception(error)
+        else:
+            flight.future.set_result(path)
+
+    def opened(self, flight):
+        """
+        Record that a follower has opened the flight's file.
+        """
+        with self._lock:
+            flight.followers -= 1
+            remove = flight.temporary and not flight.followers
+        if remove:
+            _remove(flight.future.result())
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,52 @@
+import time
+import threading
+
+DEFAULT_LISTING_TTL = 60
+
+class ListingCache(object):
+    """
+    In-memory listings of whole prefixes, so that the metadata of every object under a prefix comes from one paginated
+    list_objects_v2 call instead of a HEAD per object. Listings expire ttl seconds after they were made.
+    Parameters:
+    - ttl: how long a listing is trusted, in seconds. Default: 60.
+    """
+    def __init__(self, ttl=DEFAULT_LISTING_TTL):
+        self.ttl = ttl
+        self._listings = {}
+        self._lock = threading.Lock()
+
+    def list(self, client, bucket, prefix=''):
+        """
+        List every object under <bucket>/<prefix> and remember the listing.
+        Returns a dict mapping each key to its metadata, in the same form as head_object's response:
+        {'ETag': ..., 'ContentLength': ..., 'LastModified': ...}.
+        """
+        objects = {}
+        for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                objects[obj['Key']] = {'ETag': obj['ETag'], 'ContentLength': obj['Size'], 'LastModified': obj['LastModified']}
+        with self._lock:
+            self._listings[(bucket, prefix)] = (time.monotonic() + self.ttl, objects)
+        return objects
+
+    def get(self, bucket, key):
+        """
+        Return the metadata of <bucket>/<key> from an unexpired listing of a prefix of key, or None if there isn't one.
+        """
+        now = time.monotonic()
+        with self._lock:
+            for (listed_bucket, prefix), (expires, objects) in list(self._listings.items()):
+                if expires <= now:
+                    del self._listings[(listed_bucket, prefix)]
+                elif listed_bucket == bucket and key.startswith(prefix) and key in objects:
+                    return objects[key]
+        return None
+
+    def invalidate(self, bucket=None, prefix=''):
+        """
+        Forget the listings of every prefix under <bucket>/<prefix>, or all listings if bucket is None.
+        """
+        with self._lock:
+            for listed_bucket, listed_prefix in list(self._listings):
+                if bucket is None or (listed_bucket == bucket and listed_prefix.startswith(prefix)):
+                    del self._listings[(listed_bucket, listed_prefix)]
@@ -0,0 +1,61 @@
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+LOCK_DIR = '.s3fs_download.locks'
+
+class FileLock(object):
+    """
+    An exclusive advisory lock on a lock file, taken with fcntl.flock so that it is shared between processes.
+    On platforms without fcntl, locking is a no-op.
+    Parameters:
+    - path: the lock file. Created if it doesn't exist; never removed, since removing lock files races with other lockers.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def acquire(self):
+        """
+        Block until the lock is held. Returns the number of seconds spent waiting for another holder (0 if uncontended).
+        """
+        if fcntl is None:
+            return 0.0
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return 0.0
+        except BlockingIOError:
+            started = time.monotonic()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            return time.monotonic() - started
+
+    def try_acquire(self):
+        """
+        Take the lock if nobody else holds it. Returns whether it is now held.
+        """
+        if fcntl is None:
+            return True
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            os.close(self._fd)
+            self._fd = None
+            return False
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+def lock_path(dir, key):
+    return os.path.join(dir, LOCK_DIR, key + '.lock')
@@ -0,0 +1,59 @@
+import threading
+from collections import OrderedDict
+
+DEFAULT_MEMORY_OBJECT_SIZE = 2**20
+
+class MemoryCache(object):
+    """
+    An in-memory LRU cache of small, frequently read objects, so that they can be served without touching the filesystem.
+    Each entry holds an object's contents together with the ETag they were downloaded with, so callers can tell when it's stale.
+    Parameters:
+    - max_bytes: total size of the objects to keep. The least recently used objects are dropped to stay under it.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """
+        Return (etag, data) for key, or None if it isn't cached. Marks key as most recently used.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, etag, data):
+        """
+        Cache data, the contents of key at etag. Objects larger than max_bytes are not cached.
+        """
+        data = bytes(data)
+        with self._lock:
+            self._pop(key)
+            if len(data) > self.max_bytes:
+                return
+            self._entries[key] = (etag, data)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+
+    def invalidate(self, key):
+        """
+        Drop key from the cache, e.g. because the object has changed.
+        """
+        with self._lock:
+            self._pop(key)
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
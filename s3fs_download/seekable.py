@@ -0,0 +1,156 @@
+import io
+import struct
+from bisect import bisect_right
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# The zstd seekable format (contrib/seekable_format in the zstd repository): independent frames followed by a skippable
+# frame holding a seek table of each frame's compressed and decompressed size, so any offset can be read by decompressing one frame.
+SKIPPABLE_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+FOOTER = struct.Struct('<IBI')    # number of frames, descriptor, magic
+CHECKSUM_FLAG = 0x80
+DEFAULT_FRAME_SIZE = 2**20
+DEFAULT_COMPRESSION_LEVEL = 3
+
+def _require_zstandard():
+    if zstandard is None:
+        raise ImportError("Compressing the cache requires the zstandard package")
+
+def compress_file(source, out, level=DEFAULT_COMPRESSION_LEVEL, frame_size=DEFAULT_FRAME_SIZE):
+    """
+    Compress the file at path source into the file object out in the zstd seekable format. Returns the number of bytes written.
+    Parameters:
+    - level: zstd compression level. Default: 3.
+    - frame_size: uncompressed size of each independently decompressible frame. Smaller frames make random reads cheaper
+      and compress slightly worse. Default: 1MB.
+    """
+    _require_zstandard()
+    compressor = zstandard.ZstdCompressor(level=level)
+    sizes = []
+    written = 0
+    with open(source, mode='rb') as f:
+        for chunk in iter(lambda: f.read(frame_size), b''):
+            frame = compressor.compress(chunk)
+            out.write(frame)
+            written += len(frame)
+            sizes.append((len(frame), len(chunk)))
+    table = b''.join(struct.pack('<II', *size) for size in sizes) + FOOTER.pack(len(sizes), 0, SEEKABLE_MAGIC)
+    out.write(struct.pack('<II', SKIPPABLE_MAGIC, len(table)) + table)
+    return written + 8 + len(table)
+
+class SeekableZstdFile(io.RawIOBase):
+    """
+    A read-only, seekable file object of the decompressed contents of a file in the zstd seekable format.
+    Reads decompress only the frames they touch, and the last frame read is kept for the reads that follow it.
+    Parameters:
+    - path: the compressed file.
+    """
+    def __init__(self, path):
+        super(SeekableZstdFile, self).__init__()
+        _require_zstandard()
+        self.name = path
+        self._file = open(path, mode='rb')
+        try:
+            self._read_seek_table()
+        except BaseException:
+            self._file.close()
+            raise
+        self._decompressor = zstandard.ZstdDecompressor()
+        self._pos = 0
+        self._frame = None
+        self._frame_data = b''
+
+    def _read_seek_table(self):
+        f = self._file
+        end = f.seek(0, io.SEEK_END)
+        if end < FOOTER.size:
+            raise ValueError("%s is not a seekable zstd file" % self.name)
+        f.seek(end - FOOTER.size)
+        frames, descriptor, magic = FOOTER.unpack(f.read(FOOTER.size))
+        if magic != SEEKABLE_MAGIC:
+            raise ValueError("%s is not a seekable zstd file" % self.name)
+        entry_size = 12 if descriptor & CHECKSUM_FLAG else 8
+        f.seek(end - FOOTER.size - frames * entry_size)
+        table = f.read(frames * entry_size)
+        # Start offsets of each frame, compressed and decompressed, plus one past the end.
+        self._offsets, self._starts = [0], [0]
+        for i in range(frames):
+            compressed, decompressed = struct.unpack_from('<II', table, i * entry_size)
+            self._offsets.append(self._offsets[-1] + compressed)
+            self._starts.append(self._starts[-1] + decompressed)
+        self.size = self._starts[-1]
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError("Invalid whence (%r, should be 0, 1 or 2)" % whence)
+        if pos < 0:
+            raise ValueError("Negative seek position %d" % pos)
+        self._pos = pos
+        return pos
+
+    def tell(self):
+        return self._pos
+
+    def readinto(self, b):
+        view = memoryview(b).cast('B')
+        n = 0
+        while n < len(view) and self._pos < self.size:
+            data, offset = self._current()
+            count = min(len(view) - n, len(data) - offset)
+            view[n:n + count] = data[offset:offset + count]
+            n += count
+            self._pos += count
+        return n
+
+    def readall(self):
+        return self.read(max(self.size - self._pos, 0))
+
+    def readline(self, size=-1):
+        if size is None:
+            size = -1
+        line = []
+        length = 0
+        while self._pos < self.size and (size < 0 or length < size):
+            data, offset = self._current()
+            limit = len(data) if size < 0 else min(len(data), offset + size - length)
+            end = data.find(b'\n', offset, limit) + 1 or limit
+            line.append(data[offset:end])
+            length += end - offset
+            self._pos += end - offset
+            if data[end - 1:end] == b'\n':
+                break
+        return b''.join(line)
+
+    def _current(self):
+        """
+        Return the decompressed frame holding the current position, and the position's offset in it.
+        """
+        i = bisect_right(self._starts, self._pos) - 1
+        if i != self._frame:
+            self._file.seek(self._offsets[i])
+            compressed = self._file.read(self._offsets[i + 1] - self._offsets[i])
+            self._frame_data = self._decompressor.decompress(compressed, max_output_size=self._starts[i + 1] - self._starts[i])
+            self._frame = i
+        return self._frame_data, self._pos - self._starts[i]
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+            self._frame_data = b''
+        super(SeekableZstdFile, self).close()
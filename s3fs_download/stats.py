@@ -0,0 +1,153 @@
+import socket
+import threading
+from bisect import bisect_left
+from collections import Counter
+
+# Upper bounds of the histogram buckets, Prometheus-style. Every histogram also has a +Inf bucket.
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+BYTES_BUCKETS = tuple(2**10 * 4**i for i in range(13))         # 1KB to 16GB
+THROUGHPUT_BUCKETS = tuple(2**16 * 4**i for i in range(10))    # 64KB/s to 16GB/s
+
+HISTOGRAMS = [
+    # (event field, histogram name, buckets)
+    ('ttfb', 'ttfb_seconds', SECONDS_BUCKETS),
+    ('seconds', 'open_seconds', SECONDS_BUCKETS),
+    ('bytes', 'downloaded_bytes', BYTES_BUCKETS),
+    ('throughput', 'throughput_bytes_per_second', THROUGHPUT_BUCKETS),
+    ('disk_write_seconds', 'disk_write_seconds', SECONDS_BUCKETS),
+]
+
+class Histogram(object):
+    """
+    A histogram with fixed buckets, like a Prometheus histogram.
+    Parameters:
+    - buckets: the buckets' upper bounds, in increasing order.
+    """
+    def __init__(self, buckets):
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """
+        Return (upper bound, number of observations <= it) pairs, ending with (float('inf'), count).
+        """
+        total, pairs = 0, []
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+    def as_dict(self):
+        return {'buckets': self.cumulative(), 'sum': self.sum, 'count': self.count}
+
+class DownloadStats(object):
+    """
+    Aggregates the events S3Downloader reports for each open: how many came from each source (cache tier or S3),
+    and histograms of time to first byte, open time, bytes downloaded, throughput and time spent writing to disk.
+    """
+    def __init__(self):
+        self.opens = 0
+        self.sources = Counter()
+        self.bytes = 0
+        self.retries = 0
+        self.histograms = {name: Histogram(buckets) for field, name, buckets in HISTOGRAMS}
+        self._lock = threading.Lock()
+
+    def record(self, event):
+        with self._lock:
+            self.opens += 1
+            self.sources[event['source']] += 1
+            self.bytes += event['bytes']
+            self.retries += event['retries']
+            for field, name, buckets in HISTOGRAMS:
+                if event.get(field) is not None:
+                    self.histograms[name].observe(event[field])
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'opens': self.opens,
+                'hits': self.opens - self.sources['s3'],
+                'misses': self.sources['s3'],
+                'sources': dict(self.sources),
+                'bytes': self.bytes,
+                'retries': self.retries,
+                'histograms': {name: histogram.as_dict() for name, histogram in self.histograms.items()},
+            }
+
+    def prometheus(self, metrics=None, prefix='s3fs_download'):
+        """
+        Render the statistics (and the counters in metrics, e.g. S3Downloader.metrics) in the Prometheus text exposition format.
+        """
+        stats = self.as_dict()
+        lines = ['# TYPE %s_opens_total counter' % prefix]
+        for source, count in sorted(stats['sources'].items()):
+            lines.append('%s_opens_total{source="%s"} %d' % (prefix, _escape(source), count))
+        for name in ('bytes', 'retries'):
+            lines.append('# TYPE %s_%s_total counter' % (prefix, name))
+            lines.append('%s_%s_total %d' % (prefix, name, stats[name]))
+        for name, histogram in sorted(stats['histograms'].items()):
+            lines.append('# TYPE %s_%s histogram' % (prefix, name))
+            for bound, count in histogram['buckets']:
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('%s_%s_bucket{le="%s"} %d' % (prefix, name, le, count))
+            lines.append('%s_%s_sum %r' % (prefix, name, histogram['sum']))
+            lines.append('%s_%s_count %d' % (prefix, name, histogram['count']))
+        for name, value in sorted((metrics or {}).items()):
+            lines.append('# TYPE %s_%s counter' % (prefix, name))
+            lines.append('%s_%s %r' % (prefix, name, value))
+        return '\n'.join(lines) + '\n'
+
+class StatsdExporter(object):
+    """
+    Sends each open's measurements to a statsd server over UDP. Pass it to S3Downloader as on_open.
+    Timings are sent in milliseconds, bytes and retries as counters, throughput as a gauge.
+    Parameters:
+    - host, port: the statsd server. Default: localhost:8125.
+    - prefix: prefix of every metric name. Default: 's3fs_download'.
+    """
+    def __init__(self, host='localhost', port=8125, prefix='s3fs_download'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, event):
+        try:
+            self._socket.sendto('\n'.join(self.format(event)).encode('utf-8'), self.address)
+        except OSError:
+            # Metrics are best-effort; never fail a read because statsd is unreachable.
+            pass
+
+    def format(self, event):
+        """
+        Return the statsd lines for one open.
+        """
+        source = _statsd_name(event['source'])
+        lines = ['%s.opens.%s:1|c' % (self.prefix, source),
+                 '%s.bytes:%d|c' % (self.prefix, event['bytes']),
+                 '%s.open_time:%.3f|ms' % (self.prefix, event['seconds'] * 1000)]
+        if event['retries']:
+            lines.append('%s.retries:%d|c' % (self.prefix, event['retries']))
+        if event.get('ttfb') is not None:
+            lines.append('%s.ttfb:%.3f|ms' % (self.prefix, event['ttfb'] * 1000))
+        if event.get('disk_write_seconds') is not None:
+            lines.append('%s.disk_write_time:%.3f|ms' % (self.prefix, event['disk_write_seconds'] * 1000))
+        if event.get('throughput') is not None:
+            lines.append('%s.throughput:%d|g' % (self.prefix, event['throughput']))
+        return lines
+
+    def close(self):
+        self._socket.close()
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _statsd_name(value):
+    return ''.join(c if c.isalnum() or c in '-_' else '_' for c in value)
@@ -0,0 +1,643 @@
+import os
+import re
+import zlib
+import time
+import base64
+import struct
+import hashlib
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_EXCEPTION
+from botocore.exceptions import ClientError
+
+DEFAULT_PART_SIZE = 2**20 * 8
+DEFAULT_MAX_CONCURRENCY = 10
+
+# Bounds and target duration for the chunk size chosen by buf_size='auto'.
+ADAPTIVE_MIN_CHUNK = 2**16
+ADAPTIVE_MAX_CHUNK = 2**22
+ADAPTIVE_CHUNK_SECONDS = 0.1
+
+DEFAULT_CHECKSUM_RETRIES = 2
+READBACK_CHUNK = 2**20
+# GetObjectAttributes lists at most this many parts per call.
+MAX_LISTED_PARTS = 1000
+# urllib3 implements readinto() with a read() and a copy, so response bodies are read at most this much at a time to keep those copies small.
+READINTO_CHUNK = 2**18
+
+# Full-object checksums that S3 may return when asked with ChecksumMode='ENABLED', most preferred first.
+CHECKSUM_FIELDS = [
+    ('sha256', 'ChecksumSHA256'),
+    ('crc32c', 'ChecksumCRC32C'),
+    ('sha1', 'ChecksumSHA1'),
+    ('crc32', 'ChecksumCRC32'),
+]
+
+try:
+    from crc32c import crc32c as _crc32c
+except ImportError:
+    try:
+        from awscrt.checksums import crc32c as _crc32c
+    except ImportError:
+        _crc32c = None
+
+_CONTENT_RANGE = re.compile(r'bytes (\d+)-(\d+)/(\d+)')
+_MD5_ETAG = re.compile(r'^[0-9a-f]{32}$')
+_MULTIPART_ETAG = re.compile(r'^[0-9a-f]{32}-(\d+)$')
+_seek_lock = threading.Lock()
+
+def part_ranges(size, part_size, start=0):
+    """
+    Split the byte range [start, size) into (start, end) pairs of at most part_size bytes.
+    """
+    return [(offset, min(offset + part_size, size)) for offset in range(start, size, part_size)]
+
+def pwrite(fd, data, offset):
+    """
+    Write data to fd at offset without moving the file position.
+    Falls back to a locked seek and write on platforms without os.pwrite.
+    """
+    if hasattr(os, 'pwrite'):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+    else:
+        with _seek_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            os.write(fd, data)
+
+class DownloadCancelled(Exception):
+    pass
+
+class ChecksumMismatch(IOError):
+    pass
+
+class _Crc(object):
+    # hashlib-style wrapper around an incremental CRC function.
+    def __init__(self, crc):
+        self.crc = crc
+        self.value = 0
+
+    def update(self, data):
+        self.value = self.crc(data, self.value)
+
+    def digest(self):
+        return struct.pack('>I', self.value & 0xffffffff)
+
+def _new_hash(algorithm):
+    if algorithm == 'crc32':
+        return _Crc(zlib.crc32)
+    if algorithm == 'crc32c':
+        return _Crc(_crc32c)
+    return hashlib.new(algorithm)
+
+def expected_checksum(client, bucket, key, resp, background=False, max_workers=DEFAULT_MAX_CONCURRENCY):
+    """
+    Work out what a download of the object described by resp (a GetObject response) can be verified against.
+    Plain ETags are the MD5 of the object, and multipart ETags the MD5 of its parts' MD5s, whose sizes part_sizes() looks up.
+    If the object is encrypted with SSE-KMS or SSE-C, its ETag isn't an MD5, so a HEAD asks for the x-amz-checksum-* headers instead.
+    Returns (algorithm, expected value, part sizes or None), or None if there's nothing to verify against.
+    Parameters:
+    - background: look up the part sizes on a background thread, so the download needn't wait for them. The part sizes are then a
+      Future, which resolves to None if they can't be found; StreamingChecksum accepts it as is, and resolved() waits for it.
+    - max_workers: maximum number of requests part_sizes() sends at once.
+    """
+    etag = (resp.get('ETag') or '').strip('"')
+    encrypted = (resp.get('ServerSideEncryption') or '').startswith('aws:kms') or resp.get('SSECustomerAlgorithm')
+    if not encrypted:
+        if _MD5_ETAG.match(etag):
+            return ('md5', etag, None)
+        multipart = _MULTIPART_ETAG.match(etag)
+        if multipart:
+            args = (client, bucket, key, int(multipart.group(1)), _object_size(resp), max_workers)
+            if background:
+                return ('md5', etag, _in_background(part_sizes, *args))
+            sizes = part_sizes(*args)
+            return ('md5', etag, sizes) if sizes is not None else None
+    head = client.head_object(Bucket=bucket, Key=key, IfMatch=resp['ETag'], ChecksumMode='ENABLED')
+    for algorithm, field in CHECKSUM_FIELDS:
+        value = head.get(field)
+        # Composite checksums of multipart uploads (<checksum>-<parts>) can't be checked without the part boundaries.
+        if value and '-' not in value and (algorithm != 'crc32c' or _crc32c is not None):
+            return (algorithm, value, None)
+    return None
+
+def part_sizes(client, bucket, key, parts, size, max_workers=DEFAULT_MAX_CONCURRENCY):
+    """
+    Return the sizes of the parts of a multipart upload of parts parts, or None if they don't add up to size. Parts can have any
+    sizes, so guessing them from the first would fail valid downloads. GetObjectAttributes lists them with one call per 1000 parts
+    where S3 has them (objects uploaded with additional checksums); the others take a HEAD each, up to max_workers at once.
+    """
+    sizes = {}
+    marker = None
+    try:
+        while True:
+            kwargs = {'PartNumberMarker': marker} if marker else {}
+            attributes = client.get_object_attributes(Bucket=bucket, Key=key, ObjectAttributes=['ObjectParts'],
+                                                      MaxParts=MAX_LISTED_PARTS, **kwargs)
+            listed = attributes.get('ObjectParts') or {}
+            for part in listed.get('Parts') or []:
+                sizes[part['PartNumber']] = part['Size']
+            marker = listed.get('NextPartNumberMarker')
+            if not listed.get('IsTruncated') or not marker:
+                break
+    except ClientError:
+        sizes = {}
+    missing = [number for number in range(1, parts + 1) if number not in sizes]
+    if missing:
+        # No IfMatch here: some S3 implementations compare it with the part's ETag. The ranged GETs pin the version anyway.
+        def head(number):
+            return client.head_object(Bucket=bucket, Key=key, PartNumber=number)['ContentLength']
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(missing))) as pool:
+            sizes.update(zip(missing, pool.map(head, missing)))
+    result = [sizes[number] for number in range(1, parts + 1)]
+    return result if sum(result) == size else None
+
+def resolved(expected):
+    """
+    Wait for the part sizes of an expected_checksum(..., background=True) result. Returns the result with them filled in, or None if
+    they couldn't be found.
+    """
+    if expected is None or not isinstance(expected[2], Future):
+        return expected
+    sizes = _part_sizes_result(expected[2])
+    return (expected[0], expected[1], sizes) if sizes is not None else None
+
+def _part_sizes_result(future):
+    try:
+        return future.result()
+    except ClientError:
+        # E.g. no permission to HEAD the object: download it unverified rather than not at all.
+        return None
+
+def _in_background(fn, *args):
+    """
+    Call fn(*args) on a new daemon thread. Returns a Future of its result.
+    """
+    future = Future()
+    def run():
+        future.set_running_or_notify_cancel()
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+class StreamingChecksum(object):
+    """
+    Computes the checksum of an object while it downloads. Chunks written in order are hashed straight from the download buffer;
+    chunks written ahead of that (by other parts) are read back from the file once everything before them has landed.
+    Parameters:
+    - algorithm: 'md5', 'sha1', 'sha256', 'crc32' or 'crc32c'.
+    - part_size: size of each part of a multipart upload, or a list of the parts' sizes. If given, each part is hashed separately
+      and the result has the form of a multipart ETag: the MD5 of the parts' digests followed by -<number of parts>.
+      May also be a Future of the list (see expected_checksum()): until it resolves, writes are only recorded, and they are read back
+      from the file to be hashed once it has. If it resolves to None, there's nothing to verify and result() returns None.
+    """
+    def __init__(self, algorithm, part_size=None):
+        self.algorithm = algorithm
+        self.offset = 0
+        self._hash = _new_hash(algorithm)
+        self._parts = []
+        self._landed = {}
+        self._lock = threading.Lock()
+        self._pending = part_size if isinstance(part_size, Future) else None
+        self._verifiable = True
+        self._set_part_size(None if self._pending is not None else part_size)
+
+    def _set_part_size(self, part_size):
+        self.part_size = part_size
+        # Offsets where the current part starts and ends, and the sizes of the parts after it.
+        self._sizes = iter(part_size) if isinstance(part_size, (list, tuple)) else itertools.repeat(part_size)
+        self._part_start = 0
+        self._part_end = next(self._sizes, None) if part_size else None
+
+    def update(self, fd, offset, data):
+        """
+        Record that data has been written to fd at offset.
+        """
+        with self._lock:
+            if self._pending is not None and self._pending.done():
+                self._resolve()
+            if not self._verifiable:
+                return
+            if self._pending is None and offset == self.offset:
+                self._feed(data)
+            elif offset >= self.offset:
+                self._landed[offset] = offset + len(data)
+            if self._pending is None:
+                self._catch_up(fd)
+
+    def result(self, fd, size):
+        """
+        Hash whatever hasn't been hashed yet of the first size bytes of fd, and return the checksum: hex for MD5s
+        (as in ETags), base64 for the others (as in x-amz-checksum-* headers). Returns None if the part sizes couldn't be found.
+        """
+        with self._lock:
+            if self._pending is not None:
+                self._resolve()
+            if not self._verifiable:
+                return None
+            self._landed = {self.offset: size} if self.offset < size else {}
+            self._catch_up(fd)
+            if self.part_size:
+                if self.offset > self._part_start or not self._parts:
+                    self._parts.append(self._hash.digest())
+                return '%s-%d' % (hashlib.md5(b''.join(self._parts)).hexdigest(), len(self._parts))
+            if self.algorithm == 'md5':
+                return self._hash.hexdigest()
+            return base64.b64encode(self._hash.digest()).decode('ascii')
+
+    def _resolve(self):
+        sizes = _part_sizes_result(self._pending)
+        self._pending = None
+        if sizes is None:
+            # Nothing to verify against; stop recording writes.
+            self._verifiable = False
+            self._landed = {}
+        else:
+            self._set_part_size(sizes)
+
+    def _catch_up(self, fd):
+        while self.offset in self._landed:
+            end = self._landed.pop(self.offset)
+            while self.offset < end:
+                data = os.pread(fd, min(end - self.offset, READBACK_CHUNK), self.offset)
+                if not data:
+                    return
+                self._feed(data)
+
+    def _feed(self, data):
+        view = memoryview(data)
+        while view:
+            n = len(view)
+            if self._part_end is not None:
+                n = min(n, self._part_end - self.offset)
+            self._hash.update(view[:n])
+            self.offset += n
+            view = view[n:]
+            if self.offset == self._part_end:
+                self._parts.append(self._hash.digest())
+                self._hash = _new_hash(self.algorithm)
+                self._part_start = self.offset
+                size = next(self._sizes, None)
+                # Past the last part, anything else would be hashed as one more part.
+                self._part_end = self.offset + size if size else None
+
+class DownloadProgress(object):
+    """
+    Tracks which bytes of a download have landed in the local file, so readers can consume a file while it is still downloading.
+    high_water is the length of the prefix of the file that is completely written.
+    """
+    def __init__(self, size=None):
+        self.size = size
+        self.high_water = 0
+        self.done = False
+        self.error = None
+        self.cancelled = False
+        self._pending = {}
+        self._cond = threading.Condition()
+
+    def advance(self, start, end):
+        """
+        Record that bytes [start, end) have been written.
+        """
+        with self._cond:
+            self._pending[start] = max(end, self._pending.get(start, end))
+            high_water = self.high_water
+            while high_water in self._pending:
+                high_water = self._pending.pop(high_water)
+            if high_water != self.high_water:
+                self.high_water = high_water
+                self._cond.notify_all()
+
+    def finish(self, error=None):
+        """
+        Mark the download as complete, or as failed with error.
+        """
+        with self._cond:
+            self.done = True
+            self.error = error
+            if error is None and self.size is not None:
+                self.high_water = self.size
+            self._cond.notify_all()
+
+    def cancel(self):
+        """
+        Ask the download to stop at the next chunk boundary, and not to start any more parts.
+        """
+        with self._cond:
+            self.cancelled = True
+            self._cond.notify_all()
+
+    def wait(self, offset=None):
+        """
+        Block until the first offset bytes are written, or until the download finishes if offset is None.
+        Returns the number of bytes available. Raises the download's error if it failed.
+        """
+        with self._cond:
+            while not self.done and (offset is None or self.high_water < offset):
+                self._cond.wait()
+            if self.error is not None:
+                raise self.error
+            return self.high_water
+
+class ParallelDownload(object):
+    """
+    Download a single S3 object into a local file with concurrent ranged GETs.
+    The first part is fetched on the calling thread, which also tells us the object's size and ETag;
+    the remaining parts are fetched on a thread pool and written into place with pwrite().
+    Parameters:
+    - client: a boto3 S3 client.
+    - bucket: bucket of the object.
+    - key: key of the object.
+    - part_size: size of each ranged GET. Default: 8MB.
+    - max_concurrency: maximum number of ranged GETs in flight at once. Default: 10.
+    - buf_size: size of chunk to read from each response body before writing to disk, or 'auto' to adapt the chunk size to the
+      observed throughput (between 64KB and 4MB, aiming for about 0.1s per chunk). Each worker thread reads into one recycled buffer.
+    - if_none_match: ETag of a copy we already have. If the object still has this ETag, start() returns False
+      and nothing is downloaded.
+    - progress: a DownloadProgress to update as chunks are written.
+    - on_range: called as on_range(start, end) from the writing thread once each byte range has been completely written.
+    - verify: Checksum the data as it is written and compare it with the object's ETag or x-amz-checksum-* headers (see expected_checksum()).
+      A mismatch raises ChecksumMismatch, after downloading the object again up to max_retries times (unless progress is given, since
+      readers may already have seen the data). The verified checksum is available as digest, in the form '<algorithm>:<value>'.
+    - max_retries: number of times to download the object again after a checksum mismatch. Default: 2.
+    """
+    def __init__(self, client, bucket, key, part_size=DEFAULT_PART_SIZE,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY, buf_size=DEFAULT_PART_SIZE, if_none_match=None,
+                 progress=None, on_range=None, verify=False, max_retries=DEFAULT_CHECKSUM_RETRIES):
+        if part_size < 1:
+            raise ValueError('part_size must be positive')
+        if max_concurrency < 1:
+            raise ValueError('max_concurrency must be positive')
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.max_concurrency = max_concurrency
+        if buf_size != 'auto' and buf_size < 1:
+            raise ValueError("buf_size must be positive or 'auto'")
+        self.buf_size = buf_size
+        self.if_none_match = if_none_match
+        self.progress = progress
+        self.on_range = on_range
+        self.verify = verify
+        self.max_retries = max_retries
+        self.retries = 0
+        # Instrumentation: latency of the first GET, bytes received and time spent in pwrite(), across all attempts.
+        self.ttfb = None
+        self.bytes_transferred = 0
+        self.write_seconds = 0.0
+        self._stats_lock = threading.Lock()
+        self.size = None
+        self.etag = None
+        self.last_modified = None
+        self.digest = None
+        self._expected = None
+        self._checksum = None
+        self._first = None
+        self._local = threading.local()
+
+    def start(self):
+        """
+        Issue the first ranged GET. Returns False if the object matches if_none_match, True otherwise.
+        """
+        kwargs = {'IfNoneMatch': self.if_none_match} if self.if_none_match else {}
+        started = time.monotonic()
+        try:
+            resp = self.client.get_object(Bucket=self.bucket, Key=self.key,
+                                          Range='bytes=0-%d' % (self.part_size - 1), **kwargs)
+        except ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code in ('304', 'NotModified'):
+                self.ttfb = time.monotonic() - started
+                return False
+            if code != 'InvalidRange':
+                raise
+            # Zero-length objects can't satisfy any range.
+            resp = self.client.get_object(Bucket=self.bucket, Key=self.key, **kwargs)
+        if self.ttfb is None:
+            self.ttfb = time.monotonic() - started
+        self.etag = resp.get('ETag')
+        self.last_modified = resp.get('LastModified')
+        self.size = _object_size(resp)
+        self._first = resp
+        if self.verify:
+            try:
+                # Multipart part sizes are looked up while the download runs.
+                self._expected = expected_checksum(self.client, self.bucket, self.key, resp, background=True,
+                                                   max_workers=self.max_concurrency)
+            except ClientError:
+                # E.g. no permission to HEAD the object: download it unverified rather than not at all.
+                self._expected = None
+        return True
+
+    def run(self, fd, ranges=None):
+        """
+        Download the object into fd, resizing the file to the object's size. Returns the object's size.
+        The first part always comes from start(). If ranges is given, only those (start, end) byte ranges are fetched
+        after it, e.g. to resume a partial download; by default the rest of the object is.
+        """
+        if self._first is None and not self.start():
+            raise ValueError('Object has not been modified')
+        if self.progress is not None:
+            self.progress.size = self.size
+        try:
+            while True:
+                resp, self._first = self._first, None
+                if self._expected is not None:
+                    self._checksum = StreamingChecksum(self._expected[0], self._expected[2])
+                try:
+                    self._run(fd, resp, ranges)
+                    self._verify(fd)
+                    break
+                except ChecksumMismatch:
+                    if self.progress is not None or self.retries >= self.max_retries:
+                        raise
+                    self.retries += 1
+                    ranges = None
+                    self.if_none_match = None
+                    self.start()
+        except BaseException as e:
+            if self.progress is not None:
+                self.progress.finish(e)
+            raise
+        if self.progress is not None:
+            self.progress.finish()
+        return self.size
+
+    def _verify(self, fd):
+        checksum, self._checksum = self._checksum, None
+        if checksum is None:
+            self.digest = None
+            return
+        algorithm, expected, part_size = self._expected
+        actual = checksum.result(fd, self.size)
+        if actual is None:
+            self.digest = None
+            return
+        if actual != expected:
+            raise ChecksumMismatch('%s checksum of %s/%s is %s, expected %s' % (algorithm, self.bucket, self.key, actual, expected))
+        self.digest = '%s:%s' % (algorithm, actual)
+
+    def _run(self, fd, resp, ranges):
+        if os.fstat(fd).st_size != self.size:
+            os.ftruncate(fd, self.size)
+
+        first_length = min(self.part_size, self.size)
+        if ranges is None:
+            ranges = part_ranges(self.size, self.part_size, start=first_length)
+        else:
+            ranges = [(max(start, first_length), end) for start, end in ranges if end > first_length]
+        if not ranges or self.max_concurrency == 1:
+            self._write_first(fd, resp['Body'], first_length)
+            for start, end in ranges:
+                self._fetch_range(fd, start, end)
+            return self.size
+
+        # The calling thread streams the first part, so it counts towards max_concurrency.
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency - 1, len(ranges))) as pool:
+            futures = [pool.submit(self._fetch_range, fd, start, end) for start, end in ranges]
+            try:
+                self._write_first(fd, resp['Body'], first_length)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+            _wait_all(futures)
+        return self.size
+
+    def fetch_ranges(self, fd, ranges):
+        """
+        Fetch only the given (start, end) byte ranges into fd, e.g. to fill in the gaps of a partial download.
+        If self.etag is set, a changed object raises a PreconditionFailed ClientError instead of mixing versions.
+        """
+        if len(ranges) <= 1 or self.max_concurrency == 1:
+            for start, end in ranges:
+                self._fetch_range(fd, start, end)
+            return
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(ranges))) as pool:
+            _wait_all([pool.submit(self._fetch_range, fd, start, end) for start, end in ranges])
+
+    def fetch_into(self, view, ranges, offset=0):
+        """
+        Fetch the given (start, end) byte ranges of the object straight into view, a writable buffer holding the object's bytes from
+        offset on, with each response body read directly into its slice of view: no file, and no intermediate buffer.
+        If self.etag is set, a changed object raises a PreconditionFailed ClientError instead of mixing versions.
+        """
+        view = memoryview(view).cast('B')
+        if len(ranges) <= 1 or self.max_concurrency == 1:
+            for start, end in ranges:
+                self._fetch_range_into(view, start - offset, start, end)
+            return
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(ranges))) as pool:
+            _wait_all([pool.submit(self._fetch_range_into, view, start - offset, start, end) for start, end in ranges])
+
+    def _fetch_range_into(self, view, position, start, end):
+        kwargs = {'IfMatch': self.etag} if self.etag else {}
+        resp = self.client.get_object(Bucket=self.bucket, Key=self.key,
+                                      Range='bytes=%d-%d' % (start, end - 1), **kwargs)
+        n = _fill(resp['Body'], view[position:position + end - start])
+        if n != end - start:
+            raise IOError('Got %d bytes of %s/%s at %d, expected %d' % (n, self.bucket, self.key, start, end - start))
+        with self._stats_lock:
+            self.bytes_transferred += n
+
+    def _fetch_range(self, fd, start, end):
+        if self.progress is not None and self.progress.cancelled:
+            raise DownloadCancelled()
+        kwargs = {'IfMatch': self.etag} if self.etag else {}
+        resp = self.client.get_object(Bucket=self.bucket, Key=self.key,
+                                      Range='bytes=%d-%d' % (start, end - 1), **kwargs)
+        self._write_body(fd, resp['Body'], start, end - start)
+        if self.on_range is not None:
+            self.on_range(start, end)
+
+    def _write_first(self, fd, body, length):
+        self._write_body(fd, body, 0, length)
+        if self.on_range is not None:
+            self.on_range(0, length)
+
+    def _write_body(self, fd, body, offset, length):
+        if length <= 0:
+            return offset
+        adaptive = self.buf_size == 'auto'
+        view = self._buffer(min(ADAPTIVE_MAX_CHUNK if adaptive else self.buf_size, length))
+        chunk = min(ADAPTIVE_MIN_CHUNK, len(view)) if adaptive else len(view)
+        while True:
+            started = time.monotonic()
+            n = _fill(body, view[:chunk])
+            if n:
+                write_started = time.monotonic()
+                pwrite(fd, view[:n], offset)
+                with self._stats_lock:
+                    self.write_seconds += time.monotonic() - write_started
+                    self.bytes_transferred += n
+                if self._checksum is not None:
+                    self._checksum.update(fd, offset, view[:n])
+                if self.progress is not None:
+                    self.progress.advance(offset, offset + n)
+                    if self.progress.cancelled:
+                        raise DownloadCancelled()
+                offset += n
+            if n < chunk:
+                return offset
+            if adaptive:
+                chunk = _next_chunk(chunk, time.monotonic() - started, len(view))
+
+    def _buffer(self, size):
+        # Each worker thread reuses one buffer for every chunk of every part it downloads.
+        buf = getattr(self._local, 'buf', None)
+        if buf is None or len(buf) < size:
+            buf = self._local.buf = bytearray(size)
+        return memoryview(buf)[:size]
+
+def _wait_all(futures):
+    """
+    Wait for every future, raising the first error. Once one fails (or the download is cancelled), the parts still queued are
+    cancelled rather than fetched.
+    """
+    wait(futures, return_when=FIRST_EXCEPTION)
+    for future in futures:
+        # A no-op for parts that are running or finished.
+        future.cancel()
+    for future in futures:
+        if not future.cancelled():
+            future.result()
+
+def _fill(body, view):
+    """
+    Read from body into view until view is full or the body is exhausted, READINTO_CHUNK bytes at a time.
+    Returns the number of bytes read.
+    """
+    readinto = getattr(body, 'readinto', None)
+    filled = 0
+    while filled < len(view):
+        if readinto is not None:
+            n = readinto(view[filled:filled + READINTO_CHUNK])
+        else:
+            data = body.read(min(len(view) - filled, READINTO_CHUNK))
+            n = len(data)
+            view[filled:filled + n] = data
+        if not n:
+            break
+        filled += n
+    return filled
+
+def _next_chunk(chunk, elapsed, max_chunk):
+    """
+    Pick the next chunk size from the throughput of the last chunk, changing by at most a factor of two per step.
+    """
+    target = chunk / max(elapsed, 1e-6) * ADAPTIVE_CHUNK_SECONDS
+    chunk = min(max(int(target), chunk // 2), chunk * 2)
+    return min(max(chunk, ADAPTIVE_MIN_CHUNK), max_chunk)
+
+def _object_size(resp):
+    match = _CONTENT_RANGE.match(resp.get('ContentRange') or '')
+    if match:
+        return int(match.group(3))
+    return resp['ContentLength']
@@ -0,0 +1,102 @@
+import os
+import shutil
+import asyncio
+import boto3
+import pytest
+import s3fs_download as s3dl
+
+pytest.importorskip('aiobotocore')
+moto_server = pytest.importorskip('moto.server')
+
+@pytest.fixture(scope="module")
+def server():
+    """
+    aiobotocore talks HTTP, so run moto as a local server rather than patching botocore in-process.
+    """
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    srv = moto_server.ThreadedMotoServer(port=0, verbose=False)
+    srv.start()
+    host, port = srv.get_host_and_port()
+    client_kwargs = {'endpoint_url': 'http://%s:%d' % (host, port), 'region_name': 'us-east-1'}
+    client = boto3.client('s3', **client_kwargs)
+    client.create_bucket(Bucket='async-test')
+    yield {'client': client, 'client_kwargs': client_kwargs, 'bucket_name': 'async-test'}
+    srv.stop()
+
+def run(coro):
+    return asyncio.run(coro)
+
+"""
+Open and read a file that spans several ranged GETs.
+"""
+def test_async_read(server):
+    data = os.urandom(5000)
+    server['client'].put_object(Bucket='async-test', Key='big', Body=data)
+    async def main():
+        async with s3dl.AsyncS3Downloader(part_size=1024, client_kwargs=server['client_kwargs']) as d:
+            async with await d.open('async-test/big') as f:
+                return await f.read()
+    assert run(main()) == data
+
+"""
+Lazy files download on first read; readline() streams lines from the cached copy.
+"""
+def test_async_lazy_readline(server):
+    server['client'].put_object(Bucket='async-test', Key='lines', Body=b'one\ntwo\n')
+    async def main():
+        async with s3dl.AsyncS3Downloader(dir='tmp', lazy=True, client_kwargs=server['client_kwargs']) as d:
+            f = await d.open('async-test/lines')
+            assert not os.path.exists(os.path.join('tmp', 'lines'))
+            lines = [await f.readline(), await f.readline(), await f.readline()]
+            f.close()
+            return lines
+    assert run(main()) == [b'one\n', b'two\n', b'']
+    shutil.rmtree('tmp')
+
+"""
+The semaphore caps the number of files downloading at once.
+"""
+def test_async_max_downloads(server, monkeypatch):
+    for i in range(6):
+        server['client'].put_object(Bucket='async-test', Key='many/%d' % i, Body=b'%d' % i)
+    active = [0, 0]
+    download = s3dl.AsyncDownloadedS3File._download
+    async def counting_download(self):
+        active[0] += 1
+        active[1] = max(active)
+        try:
+            return await download(self)
+        finally:
+            active[0] -= 1
+    monkeypatch.setattr(s3dl.AsyncDownloadedS3File, '_download', counting_download)
+    async def main():
+        async with s3dl.AsyncS3Downloader(max_downloads=2, client_kwargs=server['client_kwargs']) as d:
+            files = await asyncio.gather(*(d.open('async-test/many/%d' % i) for i in range(6)))
+            return [await f.read() for f in files]
+    assert run(main()) == [b'%d' % i for i in range(6)]
+    assert active[1] == 2
+
+"""
+If one part fails, the others are cancelled before the file is closed, and no partial file is left to be served from the cache.
+"""
+def test_async_failed_download(server, monkeypatch):
+    server['client'].put_object(Bucket='async-test', Key='failing', Body=os.urandom(5000))
+    write_stream = s3dl.aio._write_stream
+    written = []
+    async def failing_write_stream(body, fd, offset):
+        if offset == 1024:
+            raise OSError('disk full')
+        await asyncio.sleep(0.2)
+        written.append(offset)
+        return await write_stream(body, fd, offset)
+    monkeypatch.setattr(s3dl.aio, '_write_stream', failing_write_stream)
+    async def main():
+        async with s3dl.AsyncS3Downloader(dir='tmp', use_cache=True, part_size=1024, client_kwargs=server['client_kwargs']) as d:
+            with pytest.raises(OSError):
+                await d.open('async-test/failing')
+            await asyncio.sleep(0.4)
+    run(main())
+    assert written == []
+    assert os.listdir('tmp') == []
+    shutil.rmtree('tmp')
@@ -1,23 +1,60 @@
+import io
 import os
+import zlib
+import base64
+import struct
+import hashlib
 import shutil
+import socket
+import threading
+import concurrent.futures
 import s3fs
 import pytest
 import s3fs_download as s3dl
 from random import randint
-from time import time
+from time import time, sleep
+try:
+    from moto import mock_aws
+except ImportError:
+    from moto import mock_s3 as mock_aws
 
 @pytest.fixture(scope="module")
 def bucket():
-    bucket_name = "s3_download_test_" + str(time()) + "_" + str(randint(0, 10000000000))
-    test_file = bucket_name + '/' + 'test_file'
-    test_str = b'hello world!\n'
-    fs = s3fs.S3FileSystem()
-    fs.mkdir(bucket_name)
-    with fs.open(test_file, 'wb') as f:
-        f.write(test_str)
-    yield {'bucket_name': bucket_name, 'test_file': test_file, 'test_str': test_str}
-    fs.rm(test_file)
-    fs.rmdir(bucket_name)
+    """
+    Run against moto's in-process S3 stand-in, so the suite doesn't need AWS credentials.
+    """
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    with mock_aws():
+        bucket_name = "s3-download-test-" + str(int(time())) + "-" + str(randint(0, 10000000000))
+        test_file = bucket_name + '/' + 'test_file'
+        test_str = b'hello world!\n'
+        fs = s3fs.S3FileSystem()
+        fs.mkdir(bucket_name)
+        with fs.open(test_file, 'wb') as f:
+            f.write(test_str)
+        yield {'bucket_name': bucket_name, 'test_file': test_file, 'test_str': test_str}
+        for obj in fs.s3.list_objects_v2(Bucket=bucket_name).get('Contents', []):
+            fs.s3.delete_object(Bucket=bucket_name, Key=obj['Key'])
+        fs.rmdir(bucket_name)
+
+def record_gets(d):
+    """
+    Record the Range header (or None) of every GetObject call made by an S3Downloader.
+    """
+    ranges = []
+    def before_call(params, **kwargs):
+      ranges.append(params.get('headers', {}).get('Range'))
+    d.s3.meta.events.register('before-call.s3.GetObject', before_call)
+    return ranges
+
+def put(bucket, key, data):
+    """
+    Upload data to <bucket>/<key> and return the S3 path.
+    """
+    s3fs.S3FileSystem().s3.put_object(Bucket=bucket['bucket_name'], Key=key, Body=data)
+    return bucket['bucket_name'] + '/' + key
 
 """
 Perform a basic read operation. Store the read file in the OS's temporary directory.
@@ -71,3 +108,1043 @@ def test_read_from_stale_cache(bucket):
       data = f.read()
       assert data == b'bla'
     shutil.rmtree('tmp')
+
+"""
+Download a file in many parallel ranged GETs and check that the result is byte-identical.
+"""
+def test_parallel_ranged_download(bucket):
+    data = os.urandom(10 * 1024 + 17)
+    path = put(bucket, 'ranged_file', data)
+    d = s3dl.S3Downloader(dir='tmp', part_size=1024, max_concurrency=4)
+    with d.open(path) as f:
+      assert f.read() == data
+    assert open(os.path.join('tmp', 'ranged_file'), 'rb').read() == data
+    shutil.rmtree('tmp')
+
+"""
+When one part fails, the parts still queued are never requested.
+"""
+@pytest.mark.parametrize('method', ['run', 'fetch_ranges', 'fetch_into'])
+def test_failed_part(bucket, tmpdir, method):
+    data = os.urandom(200 * 1000)
+    put(bucket, 'failing_part_file', data)
+    d = s3dl.S3Downloader(part_size=1000, max_concurrency=3)
+    gets = record_gets(d)
+    def fail_one(params, **kwargs):
+      if params.get('headers', {}).get('Range') == 'bytes=20000-20999':
+        raise IOError('part failed')
+      sleep(0.002)
+    d.s3.meta.events.register('before-call.s3.GetObject', fail_one)
+    transfer = s3dl.ParallelDownload(d.s3, bucket['bucket_name'], 'failing_part_file', part_size=1000, max_concurrency=3)
+    ranges = [(start, start + 1000) for start in range(0, len(data), 1000)]
+    with open(str(tmpdir.join('part')), 'wb+') as f, pytest.raises(IOError):
+      if method == 'run':
+        transfer.run(f.fileno())
+      elif method == 'fetch_ranges':
+        transfer.fetch_ranges(f.fileno(), ranges)
+      else:
+        transfer.fetch_into(bytearray(len(data)), ranges)
+    assert len(gets) < 40
+
+"""
+Empty objects can't satisfy a ranged GET, but should still download.
+"""
+def test_empty_file(bucket):
+    path = put(bucket, 'empty_file', b'')
+    d = s3dl.S3Downloader(part_size=1024)
+    with d.open(path) as f:
+      assert f.read() == b''
+
+"""
+Prefetch a glob of files concurrently, then open one without another GET. Streaming downloads run to completion.
+"""
+@pytest.mark.parametrize('streaming', [False, True])
+def test_prefetch(bucket, streaming):
+    paths = [put(bucket, 'prefetch/%d' % i, b'file %d' % i) for i in range(5)]
+    d = s3dl.S3Downloader(dir='tmp', streaming=streaming)
+    futures = d.prefetch(bucket['bucket_name'] + '/prefetch/*', max_workers=3)
+    assert sorted(futures) == sorted(paths)
+    for path, future in futures.items():
+      assert open(future.result(), 'rb').read() == b'file ' + path[-1].encode()
+    with open(os.path.join('tmp', 'prefetch', '0'), 'wb') as f:
+      # Overwrite the local copy; open() should serve it rather than re-downloading.
+      f.write(b'local')
+    with d.open(paths[0]) as f:
+      assert f.read() == b'local'
+    shutil.rmtree('tmp')
+
+"""
+Validated caches are served while the object's ETag is unchanged and re-downloaded once it changes.
+"""
+def test_validated_cache(bucket):
+    path = put(bucket, 'validated_file', b'version 1')
+    d = s3dl.S3Downloader(dir='tmp', use_cache=True)
+    with d.open(path) as f:
+      assert f.read() == b'version 1'
+    entry = d._index.get('validated_file')
+    assert entry['size'] == len(b'version 1') and entry['etag'] and entry['last_modified']
+    with open(os.path.join('tmp', 'validated_file'), 'wb') as f:
+      # Overwrite the cache; the object hasn't changed, so this copy is served.
+      f.write(b'local')
+    with d.open(path) as f:
+      assert f.read() == b'local'
+    put(bucket, 'validated_file', b'version 2')
+    with d.open(path) as f:
+      assert f.read() == b'version 2'
+    assert d._index.get('validated_file')['etag'] != entry['etag']
+    shutil.rmtree('tmp')
+
+"""
+Cached files without index metadata can't be validated, so they're re-downloaded unless validation is turned off.
+"""
+def test_unindexed_cache(bucket):
+    path = put(bucket, 'unindexed_file', b'remote')
+    os.makedirs('tmp')
+    with open(os.path.join('tmp', 'unindexed_file'), 'wb') as f:
+      f.write(b'local')
+    with s3dl.S3Downloader(dir='tmp', use_cache=True, validate_cache=False).open(path) as f:
+      assert f.read() == b'local'
+    with s3dl.S3Downloader(dir='tmp', use_cache=True).open(path) as f:
+      assert f.read() == b'remote'
+    shutil.rmtree('tmp')
+
+"""
+Bound the cache size. Least recently used files are evicted first, and open files are never evicted.
+"""
+def test_lru_eviction(bucket):
+    paths = [put(bucket, 'evict/%d' % i, b'x' * 100) for i in range(4)]
+    d = s3dl.S3Downloader(dir='tmp', use_cache=True, max_cache_bytes=250)
+    held = d.open(paths[0])
+    with d.open(paths[1]) as f:
+      f.read()
+    with d.open(paths[2]) as f:
+      # paths[0] is still open, so paths[1] is evicted instead.
+      f.read()
+    assert sorted(os.listdir(os.path.join('tmp', 'evict'))) == ['0', '2']
+    held.close()
+    with d.open(paths[3]) as f:
+      f.read()
+    assert sorted(os.listdir(os.path.join('tmp', 'evict'))) == ['2', '3']
+    assert d._index.total_size() == 200
+    shutil.rmtree('tmp')
+
+"""
+A file that another downloader sharing the directory (as another process would) is still downloading is never evicted.
+"""
+def test_evict_skips_downloads_in_progress(bucket, monkeypatch):
+    data = os.urandom(3000)
+    path = put(bucket, 'evict_in_progress', data)
+    started, release = threading.Event(), threading.Event()
+    fetch_range = s3dl.ParallelDownload._fetch_range
+    def gated_fetch_range(self, fd, start, end):
+      started.set()
+      release.wait(10)
+      return fetch_range(self, fd, start, end)
+    monkeypatch.setattr(s3dl.ParallelDownload, '_fetch_range', gated_fetch_range)
+    downloading = s3dl.S3Downloader(dir='tmp', part_size=1000, max_concurrency=1)
+    other = s3dl.S3Downloader(dir='tmp', part_size=1000, max_concurrency=1, use_cache=True)
+    results = {}
+    def read():
+      with downloading.open(path) as f:
+        results['data'] = f.read()
+    thread = threading.Thread(target=read)
+    thread.start()
+    assert started.wait(10)
+    assert other.evict(0) == 0
+    assert os.path.exists(os.path.join('tmp', 'evict_in_progress.part'))
+    release.set()
+    thread.join()
+    assert results == {'data': data}
+    assert other.evict(0) == 3000
+    assert not os.path.exists(os.path.join('tmp', 'evict_in_progress'))
+    shutil.rmtree('tmp')
+
+"""
+With the LFU policy, the most frequently opened file survives even if it wasn't used recently.
+"""
+def test_lfu_eviction(bucket):
+    paths = [put(bucket, 'lfu/%d' % i, b'x' * 100) for i in range(3)]
+    d = s3dl.S3Downloader(dir='tmp', use_cache=True, max_cache_bytes=250, eviction_policy='lfu')
+    for path in [paths[0], paths[0], paths[0], paths[1], paths[2]]:
+      with d.open(path) as f:
+        f.read()
+    assert sorted(os.listdir(os.path.join('tmp', 'lfu'))) == ['0', '2']
+    shutil.rmtree('tmp')
+
+"""
+Eviction candidates are read from the index a batch at a time, in policy order, and only as far as the caller gets.
+"""
+def test_eviction_candidates(tmpdir):
+    index = s3dl.CacheIndex(str(tmpdir))
+    for i in range(5):
+      index.put('key%d' % i, size=i)
+    index.touch('key0')
+    index.touch('key3')
+    index.touch('key3')
+    connect = index._connect
+    connections = []
+    def counting_connect():
+      connections.append(1)
+      return connect()
+    index._connect = counting_connect
+    candidates = index.eviction_candidates('lru', batch_size=2)
+    assert next(candidates) == ('key1', 1)
+    assert len(connections) == 1
+    assert list(candidates) == [('key2', 2), ('key4', 4), ('key0', 0), ('key3', 3)]
+    assert len(connections) == 3
+    assert [key for key, size in index.eviction_candidates('lfu', batch_size=2)] == ['key1', 'key2', 'key4', 'key0', 'key3']
+
+"""
+as_buffer() maps the local copy and returns a read-only, zero-copy view of it.
+"""
+def test_as_buffer(bucket):
+    data = os.urandom(4096)
+    path = put(bucket, 'mmap_file', data)
+    d = s3dl.S3Downloader(dir='tmp')
+    f = d.open(path)
+    buf = f.as_buffer()
+    assert isinstance(buf, memoryview) and buf.readonly
+    assert buf == data
+    held = buf[:16]
+    f.close()
+    # Views still alive when the file closes keep the mapping valid.
+    assert held == data[:16]
+    shutil.rmtree('tmp')
+
+"""
+With read_mode='mmap', read() returns memoryview slices and readline() walks the same position.
+"""
+def test_mmap_read_mode(bucket):
+    path = put(bucket, 'mmap_lines', b'first\nsecond\nthird')
+    d = s3dl.S3Downloader(read_mode='mmap')
+    with d.open(path) as f:
+      assert f.readline() == b'first\n'
+      chunk = f.read(3)
+      assert isinstance(chunk, memoryview) and chunk == b'sec'
+      assert f.readline() == b'ond\n'
+      assert f.read() == b'third'
+      assert f.read() == b''
+    with d.open(put(bucket, 'mmap_empty', b'')) as f:
+      assert f.read() == b''
+
+"""
+In streaming mode, lines from the first part can be read while later parts are still downloading.
+"""
+def test_streaming_read(bucket, monkeypatch):
+    data = b''.join(b'line %04d\n' % i for i in range(400))
+    path = put(bucket, 'streaming_file', data)
+    gate = threading.Event()
+    fetch_range = s3dl.ParallelDownload._fetch_range
+    def gated_fetch_range(self, *args):
+      gate.wait()
+      return fetch_range(self, *args)
+    monkeypatch.setattr(s3dl.ParallelDownload, '_fetch_range', gated_fetch_range)
+    d = s3dl.S3Downloader(dir='tmp', use_cache=True, part_size=1024, streaming=True)
+    with d.open(path) as f:
+      assert f.readline() == b'line 0000\n'
+      # The rest of what has landed is kept for the next readline().
+      assert f._line_buffer == data[:1024]
+      assert f.readline() == b'line 0001\n'
+      assert f.read(10) == data[20:30]
+      assert f._progress.high_water == 1024
+      gate.set()
+      assert f.read() == data[30:]
+      assert f.readline() == b''
+    assert d._index.get('streaming_file')['size'] == len(data)
+    shutil.rmtree('tmp')
+
+"""
+Closing a streaming file stops its download: parts that haven't been requested yet never are.
+"""
+def test_streaming_close(bucket):
+    data = os.urandom(200 * 1000)
+    path = put(bucket, 'cancelled_file', data)
+    d = s3dl.S3Downloader(dir='tmp', part_size=1000, max_concurrency=4, streaming=True)
+    gets = record_gets(d)
+    d.s3.meta.events.register('before-call.s3.GetObject', lambda **kwargs: sleep(0.01))
+    with d.open(path) as f:
+      assert f.read(10) == data[:10]
+    assert len(gets) < 20
+    assert not os.path.exists(os.path.join('tmp', 'cancelled_file'))
+    shutil.rmtree('tmp')
+
+"""
+seek(), tell() and readinto() behave like a regular binary file, and the file stays open across reads.
+"""
+def test_seek_tell_readinto(bucket):
+    data = bytes(range(256)) * 4
+    path = put(bucket, 'seek_file', data)
+    d = s3dl.S3Downloader()
+    with d.open(path) as f:
+      assert f.read(10) == data[:10]
+      assert f.tell() == 10
+      assert f.seek(-6, io.SEEK_END) == len(data) - 6
+      assert f.read() == data[-6:]
+      f.seek(100)
+      buf = bytearray(50)
+      assert f.readinto(buf) == 50 and buf == data[100:150]
+      assert f.seek(-10, io.SEEK_CUR) == 140
+      assert f.readline() == data[140:data.index(b'\n', 140) + 1]
+      assert f.seekable() and f.readable() and not f.writable()
+      with pytest.raises(ValueError):
+        f.seek(-1)
+
+"""
+Seeking in a lazy file that hasn't been downloaded fetches only the byte ranges that are read, e.g. a footer.
+"""
+def test_lazy_ranged_read(bucket):
+    data = os.urandom(100000)
+    path = put(bucket, 'footer_file', data)
+    d = s3dl.S3Downloader(dir='tmp', lazy=True, range_readahead=1000)
+    gets = record_gets(d)
+    with d.open(path) as f:
+      f.seek(-8, io.SEEK_END)
+      assert f.read(8) == data[-8:]
+      f.seek(50000)
+      assert f.read(10) == data[50000:50010]
+      assert f.read(10) == data[50010:50020]
+      assert gets == ['bytes=99992-99999', 'bytes=50000-50999']
+      assert not os.path.exists(os.path.join('tmp', 'footer_file'))
+      # Reading the rest of the file downloads it.
+      assert f.read() == data[50020:]
+    assert open(os.path.join('tmp', 'footer_file'), 'rb').read() == data
+
+    # Once it's cached, seeks read the local copy without any requests.
+    d = s3dl.S3Downloader(dir='tmp', lazy=True, use_cache=True, validate_cache=False, block_size=4096)
+    gets, heads = record_gets(d), []
+    d.s3.meta.events.register('before-call.s3.HeadObject', lambda params, **kwargs: heads.append(params))
+    with d.open(path) as f:
+      f.seek(-8, io.SEEK_END)
+      assert f.read(8) == data[-8:]
+    with d.open(path) as f:
+      assert f.read(10) == data[:10]
+    assert gets == [] and heads == []
+
+    # Ranges are pinned to the version the first one came from.
+    d = s3dl.S3Downloader(dir='tmp', lazy=True, range_readahead=1000)
+    with d.open(path) as f:
+      f.seek(-8, io.SEEK_END)
+      assert f.read(8) == data[-8:]
+      put(bucket, 'footer_file', os.urandom(100000))
+      f.seek(0)
+      with pytest.raises(IOError, match='changed'):
+        f.read(10)
+    shutil.rmtree('tmp')
+
+"""
+The block cache fetches only the blocks a read touches, persists them across opens, and completes the file on a full read.
+"""
+def test_block_cache(bucket):
+    data = os.urandom(10000)
+    path = put(bucket, 'block_file', data)
+    d = s3dl.S3Downloader(dir='tmp', lazy=True, block_size=1000)
+    gets = record_gets(d)
+    with d.open(path) as f:
+      f.seek(2500)
+      assert f.read(1000) == data[2500:3500]
+      assert gets == ['bytes=2000-3999']
+    assert os.path.getsize(os.path.join('tmp', 'block_file.part')) == len(data)
+    assert not os.path.exists(os.path.join('tmp', 'block_file'))
+
+    del gets[:]
+    with d.open(path) as f:
+      f.seek(2000)
+      assert f.read(3000) == data[2000:5000]
+      # Blocks 2 and 3 came from the earlier open.
+      assert gets == ['bytes=4000-4999']
+      f.seek(0)
+      assert f.read() == data
+    assert open(os.path.join('tmp', 'block_file'), 'rb').read() == data
+    assert not os.path.exists(os.path.join('tmp', 'block_file.part'))
+    assert d._index.get('block_file')['blocks'] is None
+
+    del gets[:]
+    put(bucket, 'block_file', data[::-1])
+    with d.open(path) as f:
+      # The object changed, so the complete copy is stale too.
+      assert f.read(10) == data[::-1][:10]
+      assert gets == ['bytes=0-999']
+    shutil.rmtree('tmp')
+
+"""
+buf_size is honoured, and 'auto' adapts the chunk size while still producing a byte-identical file.
+"""
+@pytest.mark.parametrize('buf_size', [100, 'auto'])
+def test_buf_size(bucket, monkeypatch, buf_size):
+    data = os.urandom(5000)
+    path = put(bucket, 'buffered_file', data)
+    chunks = []
+    fill = s3dl.transfer._fill
+    def recording_fill(body, view):
+      chunks.append(len(view))
+      return fill(body, view)
+    monkeypatch.setattr(s3dl.transfer, '_fill', recording_fill)
+    d = s3dl.S3Downloader(part_size=2048, buf_size=buf_size)
+    with d.open(path) as f:
+      assert f.buf_size == buf_size
+      assert f.read() == data
+    assert max(chunks) <= (100 if buf_size == 100 else 2048)
+
+"""
+Adaptive chunks grow on fast links and shrink on slow ones, within bounds.
+"""
+def test_adaptive_chunk_size():
+    from s3fs_download.transfer import _next_chunk, ADAPTIVE_MIN_CHUNK
+    assert _next_chunk(2**16, 0.001, 2**22) == 2**17
+    assert _next_chunk(2**20, 10.0, 2**22) == 2**19
+    assert _next_chunk(ADAPTIVE_MIN_CHUNK, 10.0, 2**22) == ADAPTIVE_MIN_CHUNK
+    assert _next_chunk(2**21, 0.001, 2**21) == 2**21
+
+"""
+Response bodies are read into the download buffer at most READINTO_CHUNK bytes at a time, however large the buffer:
+urllib3's readinto() allocates a bytes object of the size asked for and copies it.
+"""
+def test_fill():
+    from s3fs_download.transfer import _fill, READINTO_CHUNK
+    class Body(object):
+      def __init__(self, data):
+        self.data = io.BytesIO(data)
+        self.sizes = []
+      def readinto(self, b):
+        self.sizes.append(len(b))
+        return self.data.readinto(b)
+    data = os.urandom(READINTO_CHUNK * 3 + 10)
+    body, buf = Body(data), bytearray(len(data) + 100)
+    assert _fill(body, memoryview(buf)) == len(data)
+    assert bytes(buf[:len(data)]) == data
+    assert max(body.sizes) == READINTO_CHUNK
+
+"""
+An interrupted download leaves only <key>.part behind, and the next open resumes it instead of starting over.
+"""
+def test_resume_download(bucket, monkeypatch):
+    data = os.urandom(5500)
+    path = put(bucket, 'resumed_file', data)
+    fetch_range = s3dl.ParallelDownload._fetch_range
+    def flaky_fetch_range(self, fd, start, end):
+      if start == 3000:
+        raise ConnectionError('connection reset')
+      return fetch_range(self, fd, start, end)
+    monkeypatch.setattr(s3dl.ParallelDownload, '_fetch_range', flaky_fetch_range)
+    d = s3dl.S3Downloader(dir='tmp', use_cache=True, validate_cache=False, part_size=1000, max_concurrency=1)
+    with pytest.raises(ConnectionError):
+      d.open(path)
+    assert not os.path.exists(os.path.join('tmp', 'resumed_file'))
+    assert os.path.exists(os.path.join('tmp', 'resumed_file.part'))
+
+    monkeypatch.setattr(s3dl.ParallelDownload, '_fetch_range', fetch_range)
+    gets = record_gets(d)
+    with d.open(path) as f:
+      assert f.read() == data
+    assert gets == ['bytes=0-999', 'bytes=3000-3999', 'bytes=4000-4999', 'bytes=5000-5499']
+    assert not os.path.exists(os.path.join('tmp', 'resumed_file.part'))
+    assert d._index.get('resumed_file')['blocks'] is None
+    shutil.rmtree('tmp')
+
+"""
+Downloaders sharing a directory (as separate processes would) download each key once: the second open waits on the
+key's lock file and then reads the first downloader's copy without making any requests.
+"""
+def test_download_lock(bucket, monkeypatch):
+    data = os.urandom(3000)
+    path = put(bucket, 'locked_file', data)
+    started, release = threading.Event(), threading.Event()
+    fetch_range = s3dl.ParallelDownload._fetch_range
+    def gated_fetch_range(self, fd, start, end):
+      started.set()
+      release.wait(10)
+      return fetch_range(self, fd, start, end)
+    monkeypatch.setattr(s3dl.ParallelDownload, '_fetch_range', gated_fetch_range)
+    first = s3dl.S3Downloader(dir='tmp', part_size=1000, max_concurrency=1)
+    # s3fs caches instances by their arguments; spell one out so that second is a separate downloader with its own client.
+    second = s3dl.S3Downloader(dir='tmp', part_size=1000, max_concurrency=1, lock_downloads=True)
+    gets = record_gets(second)
+    results = {}
+    def read(name, d):
+      with d.open(path) as f:
+        results[name] = f.read()
+    threads = [threading.Thread(target=read, args=('first', first))]
+    threads[0].start()
+    assert started.wait(10)
+    threads.append(threading.Thread(target=read, args=('second', second)))
+    threads[1].start()
+    threads[1].join(0.2)
+    release.set()
+    for thread in threads:
+      thread.join()
+    assert results == {'first': data, 'second': data}
+    assert gets == []
+    assert first.metrics['lock_waits'] == 0
+    assert second.metrics['lock_waits'] == 1
+    assert second.metrics['lock_wait_seconds'] > 0
+    shutil.rmtree('tmp')
+
+"""
+Threads opening the same key at the same time share a single download, with or without a download directory.
+"""
+@pytest.mark.parametrize('dir', ['', 'tmp'])
+def test_single_flight(bucket, monkeypatch, dir):
+    data = os.urandom(3000)
+    path = put(bucket, 'single_flight_file', data)
+    threads = 8
+    d = s3dl.S3Downloader(dir=dir, part_size=4096)
+    joined = threading.Semaphore(0)
+    join = d._flights.join
+    def counting_join(key):
+      result = join(key)
+      joined.release()
+      return result
+    monkeypatch.setattr(d._flights, 'join', counting_join)
+    start = s3dl.ParallelDownload.start
+    def gated_start(self):
+      # Hold the leader's download until every thread has joined it.
+      for i in range(threads):
+        assert joined.acquire(timeout=10)
+      return start(self)
+    monkeypatch.setattr(s3dl.ParallelDownload, 'start', gated_start)
+    gets = record_gets(d)
+    results = []
+    def read():
+      with d.open(path) as f:
+        results.append(f.read())
+    workers = [threading.Thread(target=read) for i in range(threads)]
+    for worker in workers:
+      worker.start()
+    for worker in workers:
+      worker.join()
+    assert results == [data] * threads
+    assert gets == ['bytes=0-4095']
+    assert d.metrics['shared_downloads'] == threads - 1
+    if dir:
+      shutil.rmtree(dir)
+
+"""
+Small objects are kept in memory: later opens read them from RAM after a HEAD, until the object's ETag changes.
+"""
+def test_memory_cache(bucket):
+    path = put(bucket, 'memory_file', b'version 1\nsecond line\n')
+    put(bucket, 'large_memory_file', b'x' * 2000)
+    d = s3dl.S3Downloader(memory_cache_bytes=1000, memory_cache_max_object=100)
+    gets = record_gets(d)
+    with d.open(path) as f:
+      assert f.read() == b'version 1\nsecond line\n'
+    with d.open(path) as f:
+      assert isinstance(f._file, io.BytesIO)
+      assert f.readline() == b'version 1\n'
+      assert f.read() == b'second line\n'
+    assert len(gets) == 1
+    assert d.metrics['memory_hits'] == 1
+
+    put(bucket, 'memory_file', b'version 2\n')
+    with d.open(path) as f:
+      assert f.read() == b'version 2\n'
+    assert len(gets) == 2
+    with d.open(bucket['bucket_name'] + '/large_memory_file') as f:
+      assert f.read() == b'x' * 2000
+    assert (bucket['bucket_name'], 'large_memory_file') not in d._memory
+
+    memory = s3dl.MemoryCache(10)
+    memory.put('a', '"1"', b'aaaa')
+    memory.put('b', '"2"', b'bbbb')
+    memory.get('a')
+    memory.put('c', '"3"', b'cccc')
+    assert 'a' in memory and 'b' not in memory and 'c' in memory
+    assert memory.size == 8
+
+"""
+Files evicted from dir are demoted to the next cache tier, and promoted back into dir (without going to S3) when opened again.
+"""
+def test_cache_tiers(bucket):
+    first = put(bucket, 'tiered/first', b'1' * 600)
+    second = put(bucket, 'tiered/second', b'2' * 600)
+    d = s3dl.S3Downloader(dir='tmp/fast', use_cache=True, validate_cache=False, max_cache_bytes=1000,
+                          tiers=[('tmp/slow', None)])
+    gets = record_gets(d)
+    d.open(first).close()
+    d.open(second).close()
+    assert not os.path.exists('tmp/fast/tiered/first')
+    assert open('tmp/slow/tiered/first', 'rb').read() == b'1' * 600
+    assert len(gets) == 2
+
+    with d.open(first) as f:
+      assert f.read() == b'1' * 600
+    assert len(gets) == 2
+    assert os.path.exists('tmp/fast/tiered/first')
+    assert not os.path.exists('tmp/fast/tiered/second')
+    assert os.path.exists('tmp/slow/tiered/second')
+    fast, slow = d.tier_stats()
+    assert (fast['tier'], fast['hits'], fast['misses'], fast['size']) == ('tmp/fast', 1, 2, 600)
+    assert (slow['tier'], slow['hits'], slow['misses'], slow['size']) == ('tmp/slow', 1, 2, 1200)
+    assert sorted(os.listdir('tmp/slow/tiered')) == ['first', 'second']
+
+    # Another node sharing the slow tier evicts second between its lookup and its copy: it's downloaded again.
+    slow_tier = d._tiers[1]
+    lookup = slow_tier.lookup
+    def racing_lookup(key):
+      entry = lookup(key)
+      os.remove(slow_tier.path(key))
+      return entry
+    slow_tier.lookup = racing_lookup
+    with d.open(second) as f:
+      assert f.read() == b'2' * 600
+    assert len(gets) == 3
+    assert os.listdir('tmp/fast/tiered') == ['second']
+    shutil.rmtree('tmp')
+
+"""
+After list_prefix(), opens of cached files under the prefix are validated against the listing without any request to S3.
+"""
+def test_list_prefix(bucket):
+    paths = [put(bucket, 'listed/%d' % i, b'data %d' % i) for i in range(3)]
+    d = s3dl.S3Downloader(dir='tmp', use_cache=True, listing_ttl=60)
+    for path in paths:
+      d.open(path).close()
+    calls = []
+    d.s3.meta.events.register('before-call.s3', lambda model, **kwargs: calls.append(model.name))
+    listing = d.list_prefix(bucket['bucket_name'] + '/listed/')
+    assert sorted(listing) == ['listed/0', 'listed/1', 'listed/2']
+    assert listing['listed/0']['ContentLength'] == 6
+    assert calls == ['ListObjectsV2']
+
+    for i, path in enumerate(paths):
+      with d.open(path) as f:
+        assert f.read() == b'data %d' % i
+    assert calls == ['ListObjectsV2']
+
+    put(bucket, 'listed/1', b'changed')
+    d.list_prefix(bucket['bucket_name'] + '/listed/')
+    with d.open(paths[1]) as f:
+      assert f.read() == b'changed'
+    assert calls == ['ListObjectsV2', 'ListObjectsV2', 'GetObject']
+
+    d._listings.invalidate()
+    d.open(paths[0]).close()
+    assert calls[-1] == 'GetObject'
+    shutil.rmtree('tmp')
+
+"""
+sync() mirrors a prefix, downloading only new or changed objects, and can prune objects deleted from S3.
+"""
+def test_sync(bucket):
+    for i in range(4):
+      put(bucket, 'mirror/%d' % i, b'object %d' % i)
+    prefix = bucket['bucket_name'] + '/mirror/'
+    d = s3dl.S3Downloader()
+    assert d.sync(prefix, dest='tmp', workers=4) == {'downloaded': 4, 'skipped': 0, 'deleted': 0, 'bytes': 32}
+    assert open('tmp/mirror/2', 'rb').read() == b'object 2'
+
+    put(bucket, 'mirror/1', b'changed')
+    put(bucket, 'mirror/4', b'new')
+    s3fs.S3FileSystem().s3.delete_object(Bucket=bucket['bucket_name'], Key='mirror/3')
+    assert d.sync(prefix, dest='tmp') == {'downloaded': 2, 'skipped': 2, 'deleted': 0, 'bytes': 10}
+    assert d.sync(prefix, dest='tmp', delete=True) == {'downloaded': 0, 'skipped': 4, 'deleted': 1, 'bytes': 0}
+    assert sorted(os.listdir('tmp/mirror')) == ['0', '1', '2', '4']
+    assert open('tmp/mirror/1', 'rb').read() == b'changed'
+
+    # Decompressed copies of objects that still exist are kept.
+    import gzip
+    compressed = gzip.compress(b'text')
+    gz_path = put(bucket, 'mirror/5.gz', compressed)
+    with s3dl.S3Downloader(dir='tmp', decompress_mode='download').open(gz_path, decompress='gzip') as f:
+      assert f.read() == b'text'
+    assert d.sync(prefix, dest='tmp', delete=True) == {'downloaded': 1, 'skipped': 4, 'deleted': 0, 'bytes': len(compressed)}
+    assert sorted(os.listdir('tmp/mirror')) == ['0', '1', '2', '4', '5.gz', '5.gz.decompressed']
+    shutil.rmtree('tmp')
+
+"""
+Syncing into the download directory shares the download of a key that open() is already downloading, instead of writing
+the same <key>.part at the same time.
+"""
+def test_sync_shares_downloads(bucket, monkeypatch):
+    data = os.urandom(3000)
+    path = put(bucket, 'shared_mirror/0', data)
+    started, release = threading.Event(), threading.Event()
+    fetch_range = s3dl.ParallelDownload._fetch_range
+    def gated_fetch_range(self, fd, start, end):
+      started.set()
+      release.wait(10)
+      return fetch_range(self, fd, start, end)
+    monkeypatch.setattr(s3dl.ParallelDownload, '_fetch_range', gated_fetch_range)
+    d = s3dl.S3Downloader(dir='tmp', part_size=1000, max_concurrency=1)
+    gets = record_gets(d)
+    results = {}
+    def read():
+      with d.open(path) as f:
+        results['open'] = f.read()
+    def sync():
+      results['sync'] = d.sync(bucket['bucket_name'] + '/shared_mirror/')
+    threads = [threading.Thread(target=read)]
+    threads[0].start()
+    assert started.wait(10)
+    threads.append(threading.Thread(target=sync))
+    threads[1].start()
+    threads[1].join(0.2)
+    release.set()
+    for thread in threads:
+      thread.join()
+    assert results == {'open': data, 'sync': {'downloaded': 1, 'skipped': 0, 'deleted': 0, 'bytes': 0}}
+    assert len(gets) == 3
+    assert open('tmp/shared_mirror/0', 'rb').read() == data
+    shutil.rmtree('tmp')
+
+"""
+Downloads are checksummed as they stream to disk and compared with the object's ETag. Corrupted downloads are retried,
+and the verified checksum is kept in the cache index.
+"""
+def test_checksum_verification(bucket, monkeypatch):
+    data = os.urandom(3500)
+    path = put(bucket, 'checksummed_file', data)
+    d = s3dl.S3Downloader(dir='tmp', part_size=1000)
+    with d.open(path) as f:
+      assert f.read() == data
+    assert d._index.get('checksummed_file')['digest'] == 'md5:' + hashlib.md5(data).hexdigest()
+
+    fill = s3dl.transfer._fill
+    corruptions = [1]
+    def corrupting_fill(body, view):
+      n = fill(body, view)
+      if n and corruptions:
+        corruptions.pop()
+        view[0] ^= 0xff
+      return n
+    monkeypatch.setattr(s3dl.transfer, '_fill', corrupting_fill)
+    retries = d.metrics['checksum_retries']
+    with d.open(path) as f:
+      assert f.read() == data
+    assert d.metrics['checksum_retries'] == retries + 1
+
+    corruptions.extend([1] * 10)
+    with pytest.raises(s3dl.ChecksumMismatch):
+      d.open(path)
+    shutil.rmtree('tmp')
+
+"""
+Multipart ETags are checked part by part, whatever part size the download itself uses.
+"""
+def test_multipart_checksum(bucket):
+    client = s3fs.S3FileSystem().s3
+    def upload(key, chunks):
+      upload = client.create_multipart_upload(Bucket=bucket['bucket_name'], Key=key)
+      parts = []
+      for number, chunk in enumerate(chunks, 1):
+        resp = client.upload_part(Bucket=bucket['bucket_name'], Key=key, UploadId=upload['UploadId'],
+                                  PartNumber=number, Body=chunk)
+        parts.append({'ETag': resp['ETag'], 'PartNumber': number})
+      client.complete_multipart_upload(Bucket=bucket['bucket_name'], Key=key, UploadId=upload['UploadId'],
+                                       MultipartUpload={'Parts': parts})
+      return hashlib.md5(b''.join(hashlib.md5(chunk).digest() for chunk in chunks)).hexdigest() + '-%d' % len(chunks)
+    d = s3dl.S3Downloader(dir='tmp', part_size=2**21)
+    # Equal parts as made by the SDKs, and uneven ones, whose sizes can't be guessed from the first.
+    for key, chunks in [('multipart_file', [os.urandom(2**20 * 5), os.urandom(1000)]),
+                        ('uneven_multipart_file', [os.urandom(2**20 * 6), os.urandom(2**20 * 5), os.urandom(2**20 * 5)])]:
+      expected = upload(key, chunks)
+      retries = d.metrics['checksum_retries']
+      with d.open(bucket['bucket_name'] + '/' + key) as f:
+        assert f.read() == b''.join(chunks)
+      assert d._index.get(key)['digest'] == 'md5:' + expected
+      assert d.metrics['checksum_retries'] == retries
+
+    # The part sizes are looked up while the download runs: a streaming open can read before they're known.
+    d = s3dl.S3Downloader(dir='tmp', part_size=2**21, streaming=True)
+    found, heads = threading.Event(), []
+    def wait_for_read(**kwargs):
+      heads.append(found.wait(2))
+    d.s3.meta.events.register('before-call.s3.HeadObject', wait_for_read)
+    with d.open(bucket['bucket_name'] + '/uneven_multipart_file') as f:
+      assert f.read(10) == chunks[0][:10]
+      found.set()
+      assert f.read() == b''.join(chunks)[10:]
+    assert heads and all(heads)
+    assert d._index.get('uneven_multipart_file')['digest'] == 'md5:' + expected
+    shutil.rmtree('tmp')
+
+"""
+StreamingChecksum hashes out-of-order writes by reading them back once the bytes before them have landed.
+"""
+def test_streaming_checksum(tmpdir):
+    data = os.urandom(10000)
+    with open(str(tmpdir.join('file')), 'wb+') as f:
+      f.write(data)
+      checksum = s3dl.transfer.StreamingChecksum('crc32')
+      for start in (4000, 8000, 0, 2000, 6000):
+        checksum.update(f.fileno(), start, data[start:start + 2000])
+      assert checksum.offset == 10000
+      assert checksum.result(f.fileno(), 10000) == base64.b64encode(struct.pack('>I', zlib.crc32(data))).decode()
+
+      # Part sizes that are still being looked up: writes are hashed once they're known.
+      sizes = concurrent.futures.Future()
+      checksum = s3dl.transfer.StreamingChecksum('md5', sizes)
+      checksum.update(f.fileno(), 0, data[:3000])
+      sizes.set_result([6000, 4000])
+      checksum.update(f.fileno(), 3000, data[3000:])
+      parts = [hashlib.md5(data[:6000]).digest(), hashlib.md5(data[6000:]).digest()]
+      assert checksum.result(f.fileno(), 10000) == hashlib.md5(b''.join(parts)).hexdigest() + '-2'
+      unknown = concurrent.futures.Future()
+      unknown.set_result(None)
+      assert s3dl.transfer.StreamingChecksum('md5', unknown).result(f.fileno(), 10000) is None
+
+"""
+part_sizes() takes the part sizes from GetObjectAttributes, page by page, and sends a HEAD only for the parts it doesn't list.
+"""
+def test_part_sizes():
+    from s3fs_download.transfer import part_sizes
+    class Client(object):
+      heads = []
+      def get_object_attributes(self, PartNumberMarker=None, **kwargs):
+        if PartNumberMarker is None:
+          return {'ObjectParts': {'IsTruncated': True, 'NextPartNumberMarker': 2,
+                                  'Parts': [{'PartNumber': 1, 'Size': 6}, {'PartNumber': 2, 'Size': 5}]}}
+        return {'ObjectParts': {'IsTruncated': False, 'Parts': [{'PartNumber': 3, 'Size': 5}]}}
+      def head_object(self, PartNumber, **kwargs):
+        self.heads.append(PartNumber)
+        return {'ContentLength': 4}
+    client = Client()
+    assert part_sizes(client, 'bucket', 'key', 4, 20) == [6, 5, 5, 4]
+    assert client.heads == [4]
+    assert part_sizes(client, 'bucket', 'key', 4, 21) is None
+
+"""
+Every open is reported to on_open and aggregated by stats(), which can be exported to Prometheus or statsd.
+"""
+def test_instrumentation(bucket, monkeypatch):
+    data = os.urandom(3000)
+    path = put(bucket, 'instrumented_file', data)
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    server.settimeout(5)
+    statsd = s3dl.StatsdExporter('127.0.0.1', server.getsockname()[1], prefix='test')
+    events = []
+    def on_open(event):
+      events.append(event)
+      statsd(event)
+    d = s3dl.S3Downloader(dir='tmp', use_cache=True, part_size=1000, on_open=on_open)
+    d.open(path).close()
+    d.open(path).close()
+    miss, hit = events
+    assert (miss['source'], miss['hit'], miss['bytes'], miss['retries']) == ('s3', False, 3000, 0)
+    assert miss['ttfb'] > 0 and miss['disk_write_seconds'] > 0 and miss['throughput'] > 0
+    assert (hit['source'], hit['hit'], hit['bytes']) == ('tmp', True, 0)
+
+    stats = d.stats()
+    assert (stats['opens'], stats['hits'], stats['misses'], stats['bytes']) == (2, 1, 1, 3000)
+    assert stats['sources'] == {'s3': 1, 'tmp': 1}
+    assert stats['histograms']['ttfb_seconds']['count'] == 2
+    assert stats['histograms']['downloaded_bytes']['buckets'][-1] == (float('inf'), 2)
+    text = d.prometheus()
+    assert 's3fs_download_opens_total{source="s3"} 1' in text
+    assert 's3fs_download_ttfb_seconds_bucket{le="+Inf"} 2' in text
+    assert '# TYPE s3fs_download_open_seconds histogram' in text
+
+    lines = server.recv(65536).decode().split('\n')
+    assert lines[:2] == ['test.opens.s3:1|c', 'test.bytes:3000|c']
+    assert any(line.startswith('test.ttfb:') and line.endswith('|ms') for line in lines)
+    assert server.recv(65536).decode().startswith('test.opens.tmp:1|c')
+    statsd.close()
+    server.close()
+    shutil.rmtree('tmp')
+
+    # A streaming download can finish, and be reported, before open() returns; it is still a miss.
+    events = []
+    d = s3dl.S3Downloader(dir='tmp', part_size=1000, streaming=True, on_open=events.append)
+    download = s3dl.DownloadedS3File._download
+    def finishing_download(self, etag=None):
+      result = download(self, etag)
+      self._thread.join()
+      return result
+    monkeypatch.setattr(s3dl.DownloadedS3File, '_download', finishing_download)
+    with d.open(path) as f:
+      assert f.read() == data
+    assert [(event['source'], event['hit']) for event in events] == [('s3', False)]
+    shutil.rmtree('tmp')
+
+"""
+open(path, decompress='auto') reads gzip and bz2 objects (including multi-member gzip) decompressed, line by line.
+In 'read' mode the compressed object is cached; in 'download' mode it is decompressed on the way into the cache.
+"""
+def test_decompress(bucket):
+    import gzip, bz2
+    text = b''.join(b'line %d\n' % i for i in range(2000))
+    gz_path = put(bucket, 'compressed/text.gz', gzip.compress(text[:5000]) + gzip.compress(text[5000:]))
+    bz2_path = put(bucket, 'compressed/text.bz2', bz2.compress(text))
+    plain_path = put(bucket, 'compressed/text', text)
+
+    d = s3dl.S3Downloader(dir='tmp', use_cache=True, part_size=1000)
+    for path in (gz_path, bz2_path, plain_path):
+      with d.open(path, decompress='auto') as f:
+        assert f.readline() == b'line 0\n'
+        assert list(f) == text.splitlines(True)[1:]
+    with open('tmp/compressed/text.gz', 'rb') as f:
+      assert gzip.decompress(f.read()) == text
+    with d.open(gz_path) as f:
+      assert f.read(2) == b'\x1f\x8b'
+    with pytest.raises(ValueError):
+      d.open(gz_path, decompress='zip')
+
+    d = s3dl.S3Downloader(dir='tmp', use_cache=True, part_size=1000, decompress_mode='download')
+    with d.open(gz_path, decompress='gzip') as f:
+      assert f.readline() == b'line 0\n'
+      assert f.seek(0, io.SEEK_END) == len(text)
+    with open('tmp/compressed/text.gz.decompressed', 'rb') as f:
+      assert f.read() == text
+    assert d._index.get('compressed/text.gz.decompressed')['digest'].startswith('md5:')
+    gets = record_gets(d)
+    with d.open(gz_path, decompress='auto') as f:
+      assert f.read() == text
+    assert d.metrics['checksum_retries'] == 0
+    assert gets == [None]
+    shutil.rmtree('tmp')
+
+"""
+With cache_compression='zstd', cached files are stored in the zstd seekable format and read back transparently, with seeks
+decompressing only the frames they need. The index records logical and physical sizes, and the cache budget counts physical ones.
+"""
+def test_compressed_cache(bucket):
+    pytest.importorskip('zstandard')
+    text = b''.join(b'compressible line %d\n' % i for i in range(3000))
+    paths = [put(bucket, 'compressed_cache/%d' % i, text) for i in range(2)]
+    d = s3dl.S3Downloader(dir='tmp', use_cache=True, part_size=10000, cache_compression='zstd', cache_frame_size=4096,
+                          max_cache_bytes=len(text))
+    for path in paths:
+      with d.open(path) as f:
+        assert f.read() == text
+    entry = d._index.get('compressed_cache/0')
+    physical = os.path.getsize('tmp/compressed_cache/0')
+    assert (entry['compression'], entry['size'], entry['physical_size']) == ('zstd', len(text), physical)
+    assert physical < len(text) // 5
+    assert d._index.total_size() == 2 * physical
+    assert os.path.isfile('tmp/compressed_cache/1')
+
+    gets = record_gets(d)
+    with d.open(paths[0]) as f:
+      assert f.seek(0, io.SEEK_END) == len(text)
+      f.seek(text.index(b'compressible line 2000\n'))
+      assert f.readline() == b'compressible line 2000\n'
+      assert f.read(25) == text[text.index(b'compressible line 2001\n'):][:25]
+      assert isinstance(f._file, s3dl.seekable.SeekableZstdFile) and f._file._frame > 0
+    assert len(gets) == 1
+
+    with s3dl.seekable.SeekableZstdFile('tmp/compressed_cache/1') as f:
+      assert f.readline(10) == text[:10]
+      assert list(f) == text[10:].splitlines(True)
+
+    # Prefetched compressed files can only be read through open().
+    path = put(bucket, 'compressed_cache/prefetched', text)
+    assert d.prefetch(path)[path].result() is None
+    gets = record_gets(d)
+    with d.open(path) as f:
+      assert f.read() == text
+    assert gets == []
+    shutil.rmtree('tmp')
+
+"""
+Iterating over a file yields its lines, cut from large blocks. Lines spanning blocks, lines longer than a block, \r characters
+and a missing final newline are all handled, and tell() is exact between lines.
+"""
+@pytest.mark.parametrize('kwargs', [{}, {'read_mode': 'mmap'}, {'streaming': True}, {'lazy': True}])
+def test_iter_lines(bucket, kwargs):
+    text = b'first\nsecond\r\nthird\rstill third\n' + b'x' * 50 + b'\n\nlast'
+    path = put(bucket, 'lines_file', text)
+    d = s3dl.S3Downloader(dir='tmp', part_size=16, **kwargs)
+    lines = [b'first\n', b'second\r\n', b'third\rstill third\n', b'x' * 50 + b'\n', b'\n', b'last']
+    with d.open(path) as f:
+      assert list(f) == lines
+      assert f.tell() == len(text)
+    with d.open(path) as f:
+      for line in f:
+        if line == b'second\r\n':
+          break
+      assert f.tell() == len(b'first\nsecond\r\n')
+      assert f.readline() == b'third\rstill third\n'
+      assert f.readlines(1) == [b'x' * 50 + b'\n']
+      assert f.readlines() == [b'\n', b'last']
+    with d.open(path) as f, io.BytesIO(text) as expected:
+      # Reads and seeks inside the loop move it on, as with a regular file.
+      def mixed(f):
+        out = []
+        for line in f:
+          out.append(line)
+          if line == b'first\n':
+            out.append(f.readline())
+          elif line.startswith(b'third'):
+            out.append(f.read(3))
+          elif line == b'\n':
+            f.seek(-1, io.SEEK_CUR)
+            out.append(next(f))
+        return out
+      assert mixed(f) == mixed(expected)
+    with d.open(path) as f:
+      assert [block for start, block in f._line_blocks(8)][:3] == [[b'first\n'], [b'second\r\n'], [b'third\rstill third\n']]
+      f.seek(0)
+      assert sum((block for start, block in f._line_blocks(3)), []) == lines
+    shutil.rmtree('tmp')
+
+"""
+iter_chunks() yields fixed-size memoryviews, or blocks cut after a delimiter, and iter_line_batches() yields lists of lines,
+on downloaded files and while streaming.
+"""
+@pytest.mark.parametrize('kwargs', [{}, {'read_mode': 'mmap'}, {'streaming': True}])
+def test_iter_batches(bucket, kwargs):
+    records = [b'record %d %s\n' % (i, b'x' * (i % 7)) for i in range(40)]
+    text = b''.join(records) + b'no newline'
+    path = put(bucket, 'batched_file', text)
+    d = s3dl.S3Downloader(dir='tmp', part_size=64, **kwargs)
+    with d.open(path) as f:
+      chunks = list(f.iter_chunks(100))
+      assert all(isinstance(chunk, memoryview) for chunk in chunks)
+      assert [len(chunk) for chunk in chunks[:-1]] == [100] * (len(chunks) - 1)
+      assert b''.join(chunks) == text
+    with d.open(path) as f:
+      chunks = [bytes(chunk) for chunk in f.iter_chunks(50, delimiter=b'\n')]
+      assert b''.join(chunks) == text
+      assert all(chunk.endswith(b'\n') for chunk in chunks[:-1]) and chunks[-1] == b'no newline'
+    with d.open(path) as f:
+      batches = list(f.iter_line_batches(15))
+      assert [len(batch) for batch in batches] == [15, 15, 11]
+      assert sum(batches, []) == records + [b'no newline']
+    with d.open(path) as f:
+      for batch in f.iter_line_batches(3):
+        break
+      assert f.tell() == len(b''.join(records[:3]))
+      assert f.readline() == records[3]
+      with pytest.raises(ValueError):
+        next(f.iter_line_batches(0))
+    shutil.rmtree('tmp')
+
+"""
+load_array() reads .npy files (C or Fortran order, any size of header) and raw binary files into arrays, fetching the data with
+ranged GETs straight into the array's memory.
+"""
+@pytest.mark.filterwarnings('ignore:Stored array in format 2.0')
+def test_load_array(bucket):
+    np = pytest.importorskip('numpy')
+    def put_npy(key, array):
+      f = io.BytesIO()
+      np.save(f, array)
+      return put(bucket, key, f.getvalue())
+    d = s3dl.S3Downloader(part_size=50000, max_concurrency=4)
+    arrays = {
+      'small.npy': np.arange(10, dtype=np.int16),
+      'matrix.npy': np.random.rand(300, 200).astype(np.float32),
+      'fortran.npy': np.asfortranarray(np.arange(60000, dtype=np.int64).reshape(300, 200)),
+      'structured.npy': np.zeros(3, dtype=[('name%d' % i, 'f8') for i in range(5000)]),
+      'empty.npy': np.zeros((0, 4)),
+    }
+    for key, expected in arrays.items():
+      array = d.load_array(put_npy('arrays/' + key, expected))
+      assert array.dtype == expected.dtype and array.shape == expected.shape
+      assert array.flags.f_contiguous == expected.flags.f_contiguous
+      assert np.array_equal(array, expected)
+
+    data = np.random.rand(100000)
+    path = put(bucket, 'arrays/raw', data.tobytes())
+    gets = record_gets(d)
+    assert np.array_equal(d.load_array(path, dtype=np.float64), data)
+    assert gets[0] == 'bytes=0-%d' % (s3dl.arrays.HEADER_PROBE - 1) and len(gets) == 1 + (800000 - s3dl.arrays.HEADER_PROBE) // 50000 + 1
+    assert np.array_equal(d.load_array(path), np.frombuffer(data.tobytes(), dtype=np.uint8))
+    assert len(d.load_array(put(bucket, 'arrays/empty', b''), dtype=np.float32)) == 0
+    with pytest.raises(ValueError):
+      d.load_array(path, dtype='V7')
+    with pytest.raises(ValueError):
+      d.load_array(put_npy('arrays/wrong_dtype.npy', data), dtype=np.float32)
+    with pytest.raises(ValueError):
+      d.load_array(put_npy('arrays/objects.npy', np.array([None, 'x'], dtype=object)))